@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Check that batched glyph assignment (get_node_glyphs, with and without numpy)
+picks exactly what get_node_glyph does, ties included, then time both.
+"""
+import time
+import random
+import argparse
+
+import synth
+import slurm_io
+
+
+def check_usages(thresholds):
+    # the thresholds, halfway between each pair (ties), either side of those, and past both ends
+    usages = [-0.5, 0.0, 1.0, 1.5] + list(thresholds)
+    for before, after in zip(thresholds, thresholds[1:]):
+        middle = (before + after) / 2
+        usages += [middle, middle - 1e-12, middle + 1e-12]
+    # and what in_use / cores can actually come out as
+    usages += [used / float(cores) for cores in [1, 20, 24, 28, 36, 64, 128] for used in range(cores + 1)]
+    return usages + [random.random() for _ in range(100000)]
+
+
+def check(oc, numpy_min_nodes):
+    oc.numpy_min_nodes = numpy_min_nodes
+    for char_type in oc.char_types:
+        state_glyphs, usage_glyphs = oc.gen_state_glyphs(char_type), oc.gen_usage_glyphs(char_type)
+        thresholds = list(usage_glyphs.keys())
+        usages = check_usages(thresholds)
+        states = [random.choice(['mixed', 'allocated', 'idle', 'down*', 'reserved', 'drained', 'mixed+drain'])
+                  for _ in usages]
+        expected = [oc.get_node_glyph(s, u, state_glyphs, usage_glyphs) for s, u in zip(states, usages)]
+        if oc.get_node_glyphs(states, usages, state_glyphs, usage_glyphs) != expected:
+            raise AssertionError('get_node_glyphs differs from get_node_glyph for {}'.format(char_type))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--nodes', type=int, default=50000, help='Nodes to glyph. Default: 50000')
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = get_args()
+    oc = synth.load_script('orwell-cli.py')
+    has_numpy = slurm_io.get_numpy() is not None
+    check(oc, float('inf'))
+    if has_numpy:
+        check(oc, 0)
+    print('get_node_glyphs matches get_node_glyph (numpy {})'.format('checked' if has_numpy else 'not installed'))
+
+    random.seed(0)
+    state_glyphs, usage_glyphs = oc.gen_state_glyphs('utf8'), oc.gen_usage_glyphs('utf8')
+    states = [random.choice(['mixed', 'mixed', 'allocated', 'idle', 'down*']) for _ in range(args['nodes'])]
+    usages = [random.randint(0, 36) / 36.0 for _ in range(args['nodes'])]
+    oc.numpy_min_nodes = float('inf')
+    runs = [('get_node_glyph', lambda: [oc.get_node_glyph(s, u, state_glyphs, usage_glyphs)
+                                        for s, u in zip(states, usages)]),
+            ('get_node_glyphs', lambda: oc.get_node_glyphs(states, usages, state_glyphs, usage_glyphs))]
+    if has_numpy:
+        def numpy_glyphs():
+            oc.numpy_min_nodes = 0
+            oc.get_node_glyphs(states, usages, state_glyphs, usage_glyphs)
+        runs.append(('get_node_glyphs numpy', numpy_glyphs))
+    print('{} nodes'.format(args['nodes']))
+    for name, run in runs:
+        started = time.perf_counter()
+        run()
+        print('{:<22} {:>8.4f}s'.format(name, time.perf_counter() - started))
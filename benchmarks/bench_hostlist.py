@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Check hostlist expansion and compression against known answers and random
+round trips, then time them against the single-bracket expander they replaced.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from itertools import chain, islice
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import hostlist
+
+expansions = [
+    ('c01n01', ['c01n01']),
+    ('gpu[01,03-04],bigmem01', ['gpu01', 'gpu03', 'gpu04', 'bigmem01']),
+    ('n[8-11]', ['n8', 'n9', 'n10', 'n11']),
+    ('c[01-02]n[01-03]', ['c01n01', 'c01n02', 'c01n03', 'c02n01', 'c02n02', 'c02n03']),
+    ('r[1-2]c[1,3]n[05]x', ['r1c1n05x', 'r1c3n05x', 'r2c1n05x', 'r2c3n05x']),
+    ('None assigned', ['None assigned']),
+]
+compressions = [
+    (['gpu01', 'gpu03', 'gpu04'], 'gpu[01,03-04]'),
+    (['n8', 'n9', 'n10'], 'n[8-10]'),
+    (hostlist.expand_hostlist('c[01-40]n[01-32]'), 'c[01-40]n[01-32]'),
+    (['c01n01', 'c02n01', 'c02n02'], 'c01n01,c02n[01-02]'),
+    (['a1', 'b1', 'login'], 'a1,b1,login'),
+]
+malformed = ['c[01-02', 'c01-02]', 'c[a-b]']
+
+
+def old_expand(node_list):
+    # the single-bracket expander from before hostlist.py, for comparison
+    def expand_hostlist(node_list):
+        in_bracket = p_beg = p_end = 0
+        for i, c in enumerate(node_list):
+            if not in_bracket and c == ',':
+                yield expand_part(node_list[p_beg:p_end])
+                p_beg, p_end = i + 1, i
+            p_end += 1
+            in_bracket += int(c == '[') + -1 * int(c == ']')
+        yield expand_part(node_list[p_beg:p_end])
+
+    def expand_part(p):
+        if '[' in p:
+            r_beg, r_end, prefix = p.index('['), p.index(']'), p[:p.index('[')]
+            for sub_r in p[r_beg + 1:r_end].split(','):
+                if '-' not in sub_r:
+                    yield prefix + sub_r
+                else:
+                    lo, hi = sub_r.split('-', 1)
+                    for i in range(int(lo), int(hi) + 1):
+                        yield prefix + str(i).zfill(len(lo))
+        else:
+            yield p
+    return chain.from_iterable(expand_hostlist(node_list))
+
+
+def random_hosts(n):
+    hosts = set()
+    while len(hosts) < n:
+        hosts.add(random.choice(['c', 'gpu', 'r1c', '']) +
+                  random.choice(['%02d' % random.randint(0, 40), str(random.randint(0, 200))]) +
+                  random.choice(['', 'n%02d' % random.randint(1, 32), 'x']))
+    return hosts
+
+
+def check(rounds):
+    for text, hosts in expansions:
+        assert list(hostlist.expand_hostlist(text)) == hosts, text
+        assert list(hostlist.iter_hostlist(text)) == hosts, text
+    for hosts, text in compressions:
+        assert hostlist.compress_hostlist(hosts) == text, (text, hostlist.compress_hostlist(hosts))
+    for text in malformed:
+        try:
+            hostlist.expand_hostlist(text)
+            raise AssertionError('expected ValueError for {}'.format(text))
+        except ValueError:
+            pass
+    for _ in range(rounds):
+        hosts = random_hosts(random.randint(1, 50))
+        expanded = hostlist.expand_hostlist(hostlist.compress_hostlist(hosts))
+        assert len(expanded) == len(hosts) and set(expanded) == hosts, hosts
+    # lazy expansion of something far too big to hold
+    assert list(islice(hostlist.iter_hostlist('n[0000000001-9999999999]'), 2)) == ['n0000000001', 'n0000000002']
+
+
+def timed(func, node_lists):
+    started = time.time()
+    for node_list in node_lists:
+        for host in func(node_list):
+            pass
+    return time.time() - started
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--node-lists', type=int, default=200000,
+                        help='NodeLists to expand, as in one sacct poll. Default: 200000')
+    parser.add_argument('-d', '--distinct', type=int, default=2000,
+                        help='How many of those are different. Default: 2000')
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = get_args()
+    random.seed(0)
+    check(2000)
+    print('correctness checks passed')
+
+    distinct = ['c{:02d}n[{:02d}-{:02d}]'.format(random.randint(1, 40), lo, lo + random.randint(0, 3))
+                for lo in (random.randint(1, 28) for _ in range(args['distinct']))]
+    node_lists = [random.choice(distinct) for _ in range(args['node_lists'])]
+    print('{} NodeLists, {} distinct'.format(args['node_lists'], args['distinct']))
+    print('{:<22} {:>8}'.format('expander', 'seconds'))
+    print('{:<22} {:>8.3f}'.format('old single-bracket', timed(old_expand, node_lists)))
+    print('{:<22} {:>8.3f}'.format('iter_hostlist', timed(hostlist.iter_hostlist, node_lists)))
+    hostlist._cache.clear()
+    print('{:<22} {:>8.3f}'.format('expand_hostlist', timed(hostlist.expand_hostlist, node_lists)))
+    hosts = hostlist.expand_hostlist('c[001-400]n[01-32]')
+    started = time.time()
+    hostlist.compress_hostlist(hosts)
+    print('{:<22} {:>8.3f}'.format('compress 12800 hosts', time.time() - started))
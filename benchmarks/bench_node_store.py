@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Compare memory and build time of orwell-cli's Node/Job store against the
+defaultdict-of-dicts node_info it replaced, on synthetic sinfo/sacct output.
+"""
+import gc
+import re
+import time
+import random
+import argparse
+import tracemalloc
+from itertools import cycle
+from collections import defaultdict as dd
+
+import synth
+import hostlist
+
+# how orwell-cli split slurm output before slurm_io's rows
+slurm_delim = r' ?\|'
+
+
+def gen_lines(n_nodes, n_jobs, seed=0):
+    random.seed(seed)
+    nodes = ['c{:03d}n{:02d}'.format(i // 32 + 1, i % 32 + 1) for i in range(n_nodes)]
+    sinfo = ['HOSTNAMES|STATE|CPUS(A/I/O/T)|FREE_MEM|MEMORY|PARTITION|AVAIL_FEATURES']
+    for node in nodes:
+        used = random.randint(0, 36)
+        for partition in ['general', 'scavenge']:
+            sinfo.append('{}|mixed|{}/{}/0/36|{}|192000|{}|avx2,skylake'.format(
+                node, used, 36 - used, random.randint(0, 192000), partition))
+    sacct = ['JobID|JobName|User|Account|NodeList|Partition']
+    for i in range(n_jobs):
+        # mostly single node array tasks, like a busy cluster
+        sacct.append('{}_{}|array{}|user{}|account{}|{}|general'.format(
+            1000 + i // 1000, i % 1000, i // 1000, i % 400, i % 40, random.choice(nodes)))
+    return sinfo, sacct
+
+
+def build_dict_store(oc, sinfo_lines, sacct_lines, state_glyphs, usage_glyphs):
+    # node_info as built before the Node/Job store, kept here for comparison
+    node_info = dd(lambda: {'glyph': state_glyphs['not a node'], 'partition': set(),
+                            'feature': set(), 'gpu_type': set(),
+                            'job_info': dd(lambda: {'job_name': '', 'user': '',
+                                                    'account': '', 'job_partition': ''})})
+    header = re.split(slurm_delim, sacct_lines[0])
+    for line in sacct_lines[1:]:
+        sacct = dict(zip(header, re.split(slurm_delim, line)))
+        for node in hostlist.expand_hostlist(sacct['NodeList']):
+            job_id = sacct['JobID']
+            job_ids = [job_id, job_id.split('_')[0]] if '_' in job_id else [job_id]
+            for jid in job_ids:
+                node_info[node]['job_info'][jid]['job_name'] = sacct['JobName']
+                node_info[node]['job_info'][jid]['user'] = sacct['User']
+                node_info[node]['job_info'][jid]['account'] = sacct['Account']
+                node_info[node]['job_info'][jid]['job_partition'] = sacct['Partition']
+    header = re.split(slurm_delim, sinfo_lines[0])
+    for line in sinfo_lines[1:]:
+        sinfo = dict(zip(header, re.split(slurm_delim, line)))
+        node_name = sinfo['HOSTNAMES']
+        node_info[node_name]['glyph'] = oc.get_node_glyph(sinfo['STATE'], oc.get_cpu_usage(sinfo['CPUS(A/I/O/T)']),
+                                                          state_glyphs, usage_glyphs)
+        node_info[node_name]['partition'].add(sinfo['PARTITION'])
+        [node_info[node_name]['feature'].add(f) for f in sinfo['AVAIL_FEATURES'].split(',')]
+    return node_info
+
+
+def build_node_store(oc, sinfo_lines, sacct_lines, state_glyphs, usage_glyphs):
+    node_info = dd(lambda: oc.Node(state_glyphs['not a node']))
+    job_tracker = oc.new_job_tracker()
+    oc.update_job_tracker(job_tracker, sacct_lines, cycle('x'))
+    oc.add_job_info(node_info, job_tracker, 'cpu')
+    oc.add_node_info(node_info, sinfo_lines, dd(dict), state_glyphs, usage_glyphs, 'cpu')
+    return node_info, job_tracker
+
+
+def measure(build, *args):
+    gc.collect()
+    tracemalloc.start()
+    started = time.time()
+    store = build(*args)
+    elapsed = time.time() - started
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del store
+    return elapsed, current / 1024.0 ** 2, peak / 1024.0 ** 2
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--nodes', type=int, default=20000, help='Nodes to generate. Default: 20000')
+    parser.add_argument('-j', '--jobs', type=int, default=200000, help='Array tasks to generate. Default: 200000')
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = get_args()
+    oc = synth.load_script('orwell-cli.py')
+    state_glyphs, usage_glyphs = oc.gen_state_glyphs('ascii'), oc.gen_usage_glyphs('ascii')
+    sinfo_lines, sacct_lines = gen_lines(args['nodes'], args['jobs'])
+    print('{} nodes, {} jobs'.format(args['nodes'], args['jobs']))
+    print('{:<12} {:>8} {:>12} {:>9}'.format('store', 'build s', 'retained MiB', 'peak MiB'))
+    for name, build in [('dict', build_dict_store), ('Node/Job', build_node_store)]:
+        print('{:<12} {:>8.2f} {:>12.1f} {:>9.1f}'.format(
+            name, *measure(build, oc, sinfo_lines, sacct_lines, state_glyphs, usage_glyphs)))
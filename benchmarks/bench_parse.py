@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Time reading and splitting slurm output, per 100k rows: the line at a time
+decode, re.split and dict per row orwell-cli and queue-summary used to do,
+against slurm_io's block reader and header-indexed tuple rows.
+"""
+import io
+import re
+import sys
+import time
+import argparse
+
+import synth
+import slurm_io
+
+# how rows were split before slurm_io
+slurm_delim = r' ?\|'
+sinfo_columns = ['HOSTNAMES', 'STATE', 'CPUS(A/I/O/T)', 'FREE_MEM', 'MEMORY', 'PARTITION', 'AVAIL_FEATURES']
+sacct_columns = ['JobID', 'JobName', 'User', 'Account', 'NodeList', 'Partition']
+
+
+def old_lines(stream):
+    for line in stream:
+        if not line.startswith(b'CLUSTER: '):
+            yield line.decode().strip()
+
+
+def old_parse(stream, columns):
+    rows = 0
+    for i, line in enumerate(old_lines(stream)):
+        if i == 0:
+            header = re.split(slurm_delim, line)
+        else:
+            row = dict(zip(header, re.split(slurm_delim, line)))
+            [row[c] for c in columns]
+            rows += 1
+    return rows
+
+
+def new_parse(stream, columns):
+    rows = 0
+    header, split = slurm_io.read_rows(slurm_io.read_output_lines(stream))
+    for row in map(slurm_io.select_columns(header, columns), split):
+        rows += 1
+    return rows
+
+
+def best_of(repeat, parse, data, columns):
+    timings = []
+    for _ in range(repeat):
+        # a buffered pipe, as subprocess gives us
+        stream = io.BufferedReader(io.BytesIO(data))
+        started = time.perf_counter()
+        rows = parse(stream, columns)
+        timings.append(time.perf_counter() - started)
+    return min(timings), rows
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--nodes', type=int, default=100000, help='Nodes to generate. Default: 100000')
+    parser.add_argument('-j', '--jobs', type=int, default=500000, help='Jobs to generate. Default: 500000')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Take the best of this many runs. Default: 3')
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = get_args()
+    cluster = synth.gen_cluster(args['nodes'], args['jobs'])
+    outputs = [('sinfo', synth.sinfo_lines(cluster, sinfo_columns), sinfo_columns),
+               ('sacct', synth.sacct_lines(cluster, sacct_columns), sacct_columns)]
+    print('{:<6} {:>8} {:>16} {:>16} {:>8}'.format('output', 'rows', 'old s/100k rows', 'new s/100k rows',
+                                                   'speedup'))
+    for name, lines, columns in outputs:
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        (old, rows), (new, new_rows) = [best_of(args['repeat'], parse, data, columns) for parse in [old_parse, new_parse]]
+        if rows != new_rows:
+            sys.exit('{}: {} rows parsed the old way, {} the new'.format(name, rows, new_rows))
+        print('{:<6} {:>8} {:>16.4f} {:>16.4f} {:>7.1f}x'.format(name, rows, old * 1e5 / rows, new * 1e5 / rows,
+                                                                 old / new))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Time each stage of orwell-cli.py and queue-summary.py on synthetic clusters
+(see synth.py) of increasing size, and report the results as JSON so they can
+be compared from one commit to the next.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+from itertools import cycle
+from collections import defaultdict as dd
+
+import synth
+import slurm_io
+
+
+def best_of(repeat, stage):
+    # fastest of repeat runs, the others are mostly noise from the rest of the machine
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        stage()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def time_orwell(oc, show, filters, repeat):
+    state_glyphs, usage_glyphs = oc.gen_state_glyphs('ascii'), oc.gen_usage_glyphs('ascii')
+    plan = oc.plan_queries(show, filters)
+    plan['gres'] = True
+    sinfo_lines = list(slurm_io.get_subprocess_lines(plan['sinfo'], cache=True))
+    sacct_lines = list(slurm_io.get_subprocess_lines(plan['sacct'], cache=True))
+    gpu_info = [g for g in oc.get_gpus() if g is not None]
+    store = {}
+
+    def build_jobs():
+        store['job_tracker'] = oc.new_job_tracker()
+        oc.update_job_tracker(store['job_tracker'], sacct_lines, cycle('x'))
+
+    def add_job_info():
+        store['node_info'] = dd(lambda: oc.Node(state_glyphs['not a node']))
+        oc.add_job_info(store['node_info'], store['job_tracker'], show)
+
+    def add_node_info():
+        store['chassis'] = dd(dict)
+        oc.add_node_info(store['node_info'], sinfo_lines, store['chassis'], state_glyphs, usage_glyphs, show)
+
+    stages = [
+        ('update_job_tracker', build_jobs),
+        ('add_job_info', add_job_info),
+        ('add_node_info', add_node_info),
+        ('add_gpu_info', lambda: oc.add_gpu_info(store['node_info'], gpu_info)),
+        ('get_highlighted_nodes', lambda: oc.get_highlighted_nodes(store['node_info'], filters)),
+        ('render_node_layout', lambda: oc.render_node_layout(store['node_info'], store['chassis'], filters,
+                                                             state_glyphs, show, 'red')),
+    ]
+    timings = {}
+    for name, stage in stages:
+        timings[name] = best_of(repeat, stage)
+    return timings, {'sinfo_rows': len(sinfo_lines) - 1, 'sacct_rows': len(sacct_lines) - 1,
+                     'nodes': len(store['node_info']), 'jobs': len(store['job_tracker']['jobs'])}
+
+
+def time_queue_summary(qs, repeat):
+    levels = ['User', 'State']
+    summary = qs.summarize_jobs(levels)
+
+    def print_summary(top=None):
+        with quiet():
+            qs.print_summary(summary, levels, True, 'G', ['CPUs'], False, top)
+
+    return {'summarize_jobs': best_of(repeat, lambda: qs.summarize_jobs(levels)),
+            'print_summary': best_of(repeat, print_summary),
+            'print_summary_top': best_of(repeat, lambda: print_summary(20))}
+
+
+def run(args):
+    oc = synth.load_script('orwell-cli.py')
+    qs = synth.load_script('queue-summary.py')
+    filters = dd(list, {'partition': ['general'], 'user': ['user1']})
+    results = []
+    for n_nodes in args['nodes']:
+        n_jobs = int(n_nodes * args['jobs_per_node'])
+        print('{} nodes, {} jobs'.format(n_nodes, n_jobs), file=sys.stderr)
+        started = time.perf_counter()
+        cluster = synth.gen_cluster(n_nodes, n_jobs, args['scheme'], args['array_density'],
+                                    args['gpu_fraction'], args['gpu_mix'], args['seed'])
+        replay_dir = tempfile.mkdtemp(prefix='orwell-bench-')
+        try:
+            synth.write_replay(cluster, replay_dir, oc)
+            generated = time.perf_counter() - started
+            slurm_io.cache_settings['mode'] = 'bypass'
+            slurm_io.capture_settings['replay'] = replay_dir
+            stages, counts = time_orwell(oc, args['show'], filters, args['repeat'])
+            stages.update(time_queue_summary(qs, args['repeat']))
+        finally:
+            slurm_io.capture_settings['replay'] = None
+            shutil.rmtree(replay_dir)
+        results.append({'nodes': n_nodes, 'jobs': n_jobs, 'counts': counts,
+                        'generate_seconds': round(generated, 3),
+                        'stage_seconds': dict((k, round(v, 6)) for k, v in stages.items())})
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'params': dict((k, v) for k, v in args.items() if k != 'output'), 'results': results}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--nodes', type=lambda s: [int(n) for n in s.split(',')], default=[1000, 10000],
+                        help='Comma separated cluster sizes to time, 1000 to 100000 is sensible. Default: 1000,10000')
+    parser.add_argument('-j', '--jobs-per-node', type=float, default=10,
+                        help='Jobs (running and pending) per node. Default: 10')
+    parser.add_argument('-s', '--show', default='both', choices=['cpu', 'ram', 'both', 'job'],
+                        help='orwell-cli --show to time. Default: both')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Take the best of this many runs. Default: 3')
+    parser.add_argument('-o', '--output', help='Write the JSON here instead of stdout.')
+    synth.add_cluster_args(parser)
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = get_args()
+    report = json.dumps(run(args), indent=1, sort_keys=True)
+    if args['output'] is not None:
+        with open(args['output'], 'w') as out:
+            out.write(report + '\n')
+    else:
+        print(report)
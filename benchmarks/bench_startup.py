@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Time cold starts of common orwell-cli.py and queue-summary.py invocations, each
+in a fresh interpreter replaying a small synthetic cluster (see synth.py), and
+fail if any takes longer than the budget over a bare interpreter's startup.
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import synth
+
+# name, script and arguments of the runs to time, --replay DIR is added to all but --help
+invocations = [('orwell-cli', 'orwell-cli.py', []),
+               ('orwell-cli -s both', 'orwell-cli.py', ['-s', 'both']),
+               ('orwell-cli -y utf8 -s ram', 'orwell-cli.py', ['-y', 'utf8', '-s', 'ram']),
+               ('orwell-cli -s job', 'orwell-cli.py', ['-s', 'job']),
+               ('orwell-cli -u user1', 'orwell-cli.py', ['-u', 'user1']),
+               ('orwell-cli -y emoji -l', 'orwell-cli.py', ['-y', 'emoji', '-l']),
+               ('orwell-cli --help', 'orwell-cli.py', ['--help']),
+               ('queue-summary', 'queue-summary.py', []),
+               ('queue-summary -l User', 'queue-summary.py', ['-l', 'User'])]
+# milliseconds over a bare interpreter's startup any invocation may take
+startup_budget = 120
+
+
+def best_of(repeat, cmd, env):
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            subprocess.check_call(cmd, stdout=devnull, env=env)
+            timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-b', '--budget', type=float, default=startup_budget,
+                        help='Milliseconds over bare interpreter startup allowed. Default: {}'.format(startup_budget))
+    parser.add_argument('-r', '--repeat', type=int, default=10, help='Take the best of this many runs. Default: 10')
+    parser.add_argument('-n', '--nodes', type=int, default=500, help='Nodes in the replayed cluster. Default: 500')
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = get_args()
+    # byte-compiled modules, as an installed copy would have after its first run
+    env = dict((k, v) for k, v in os.environ.items() if k != 'PYTHONDONTWRITEBYTECODE')
+    replay_dir = tempfile.mkdtemp(prefix='orwell-startup-')
+    try:
+        synth.write_replay(synth.gen_cluster(args['nodes'], args['nodes'] * 5), replay_dir,
+                           synth.load_script('orwell-cli.py'))
+        bare = best_of(args['repeat'], [sys.executable, '-c', 'pass'], env)
+        print('{:<28} {:>8} {:>12}'.format('invocation', 'ms', 'over bare'))
+        print('{:<28} {:>8.1f}'.format('python -c pass', bare))
+        over_budget = []
+        for name, script, script_args in invocations:
+            cmd = [sys.executable, os.path.join(synth.root, script)] + script_args
+            if '--help' not in script_args:
+                cmd += ['--replay', replay_dir]
+            # the first run byte-compiles
+            best_of(1, cmd, env)
+            took = best_of(args['repeat'], cmd, env)
+            print('{:<28} {:>8.1f} {:>12.1f}'.format(name, took, took - bare))
+            if took - bare > args['budget']:
+                over_budget.append(name)
+    finally:
+        shutil.rmtree(replay_dir)
+    if len(over_budget) > 0:
+        sys.exit('Over the {:g}ms startup budget: {}'.format(args['budget'], ', '.join(over_budget)))
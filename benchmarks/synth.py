@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic cluster: sinfo, sacct and gres.conf as a large slurm
+cluster would produce them. Written out as a --record directory so that
+orwell-cli.py and queue-summary.py can be run on it with --replay DIR.
+"""
+import os
+import sys
+import random
+import argparse
+import importlib.util
+from itertools import product
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import hostlist
+import slurm_io
+
+# node names: c001n01 (32 to a chassis), node01, chassis plus gpu01 and bigmem01 nodes,
+# or c001n001 numbered up to 96 with gaps
+schemes = ['chassis', 'flat', 'mixed', 'sparse']
+# where the synthetic slurm.conf and gres.conf live
+slurm_conf = '/synthetic/slurm/slurm.conf'
+queue_sacct_cmd = ['sacct', '-XaPsR,PD,RQ', '-oUser,Account,State,Partition,ReqCPUS,ReqNodes,ReqMem,ReqGRES']
+node_states = [('mixed', 40), ('allocated', 35), ('idle', 15), ('reserved', 4), ('down*', 3), ('drained', 3)]
+job_states = [('RUNNING', 70), ('PENDING', 28), ('REQUEUED', 2)]
+
+
+def load_script(file_name):
+    spec = importlib.util.spec_from_file_location(file_name.split('.')[0].replace('-', '_'),
+                                                  os.path.join(root, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _weighted(choices):
+    return random.choices([c for c, _ in choices], [w for _, w in choices])[0]
+
+
+def parse_gpu_mix(gpu_mix):
+    # k80:3,v100:1 -> [('k80', 3.0), ('v100', 1.0)]
+    mix = []
+    for part in gpu_mix.split(','):
+        name, _, weight = part.partition(':')
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def gen_node_names(n_nodes, scheme, gpu_fraction):
+    """
+    Names of n_nodes nodes, and which of them have gpus.
+    """
+    n_gpu = int(n_nodes * gpu_fraction)
+    if scheme == 'flat':
+        names = ['node{:02d}'.format(i + 1) for i in range(n_nodes)]
+        return names, names[n_nodes - n_gpu:]
+    width = len(str((n_nodes - 1) // 32 + 1))
+    if scheme == 'sparse':
+        # 32 nodes to a chassis, spread over numbers 1-96
+        names = ['c{:0{}d}n{:03d}'.format(i // 32 + 1, width, n)
+                 for i, n in zip(range(n_nodes), (n for _ in range(n_nodes) for n in sorted(random.sample(range(1, 97), 32))))]
+        return names, names[n_nodes - n_gpu:]
+    if scheme == 'chassis':
+        names = ['c{:0{}d}n{:02d}'.format(i // 32 + 1, width, i % 32 + 1) for i in range(n_nodes)]
+        return names, names[n_nodes - n_gpu:]
+    n_bigmem = n_nodes // 50
+    n_chassis = n_nodes - n_gpu - n_bigmem
+    names = ['c{:0{}d}n{:02d}'.format(i // 32 + 1, width, i % 32 + 1) for i in range(n_chassis)]
+    gpus = ['gpu{:02d}'.format(i + 1) for i in range(n_gpu)]
+    names += ['bigmem{:02d}'.format(i + 1) for i in range(n_bigmem)] + gpus
+    return names, gpus
+
+
+def gen_cluster(n_nodes, n_jobs, scheme='chassis', array_density=0.5, gpu_fraction=0.1, gpu_mix='k80:1,v100:1',
+                seed=0):
+    """
+    A synthetic cluster as a dict of nodes (sinfo columns per node and partition),
+    jobs (sacct fields) and gres (gres.conf lines).
+    """
+    random.seed(seed)
+    names, gpu_nodes = gen_node_names(n_nodes, scheme, gpu_fraction)
+    gpu_set = set(gpu_nodes)
+    n_users = max(10, n_nodes // 20)
+    cluster = {'nodes': [], 'jobs': [], 'gres': []}
+
+    for i, name in enumerate(names):
+        cores = 36 if name not in gpu_set else 24
+        memory = 192000 if not name.startswith('bigmem') else 1536000
+        state = _weighted(node_states)
+        used = {'mixed': random.randint(1, cores - 1), 'allocated': cores}.get(state, 0)
+        free_mem = 'N/A' if state.startswith('down') else str(random.randint(0, memory))
+        partitions = ['gpu'] if name in gpu_set else ['general', 'scavenge']
+        if name.startswith('bigmem'):
+            partitions = ['bigmem', 'scavenge']
+        features = 'avx2,{}'.format(['haswell', 'broadwell', 'skylake', 'cascadelake'][(i // 512) % 4])
+        for partition in partitions:
+            cluster['nodes'].append({'HOSTNAMES': name, 'STATE': state, 'FREE_MEM': free_mem,
+                                     'CPUS(A/I/O/T)': '{}/{}/0/{}'.format(used, cores - used, cores),
+                                     'MEMORY': str(memory), 'PARTITION': partition, 'AVAIL_FEATURES': features})
+
+    # gres.conf, one line per run of nodes with the same gpu type
+    gpu_types = parse_gpu_mix(gpu_mix)
+    by_type = {}
+    for node in gpu_nodes:
+        by_type.setdefault(_weighted(gpu_types), []).append(node)
+    for gpu, nodes in sorted(by_type.items()):
+        cluster['gres'].append('NodeName={} Name=gpu Type={} File=/dev/nvidia[0-3]\n'.format(
+            hostlist.compress_hostlist(nodes), gpu))
+
+    job_id = 1000
+    while len(cluster['jobs']) < n_jobs:
+        job_id += 1
+        user = random.randint(0, n_users - 1)
+        account = 'account{}'.format(user % max(1, n_users // 8))
+        base = {'JobName': 'job{}'.format(job_id), 'User': 'user{}'.format(user), 'Account': account}
+        tasks = random.randint(10, 1000) if random.random() < array_density else 0
+        for task in range(min(max(tasks, 1), n_jobs - len(cluster['jobs']))):
+            job = dict(base)
+            state = _weighted(job_states)
+            gpus = random.choice([1, 2, 4]) if random.random() < gpu_fraction else 0
+            nodes = 1 if tasks or random.random() < 0.8 else random.randint(2, 16)
+            if gpus > 0:
+                start = random.randint(0, max(0, len(gpu_nodes) - nodes))
+                node_list = gpu_nodes[start:start + nodes]
+                job['Partition'] = 'gpu'
+            else:
+                start = random.randint(0, n_nodes - nodes)
+                node_list = names[start:start + nodes]
+                job['Partition'] = random.choice(['general', 'general', 'scavenge'])
+            job['JobID'] = '{}_{}'.format(job_id, task) if tasks else str(job_id)
+            job['State'] = state
+            job['NodeList'] = hostlist.compress_hostlist(node_list) if state == 'RUNNING' else 'None assigned'
+            job['ReqCPUS'] = str(random.choice([1, 1, 2, 4, 8, 36]) * nodes)
+            job['ReqNodes'] = str(nodes)
+            job['ReqMem'] = '{}M{}'.format(random.choice([1000, 4000, 5120, 16000]), random.choice('cn'))
+            job['ReqGRES'] = 'gpu:{}'.format(gpus) if gpus else ''
+            cluster['jobs'].append(job)
+    return cluster
+
+
+def sinfo_lines(cluster, columns):
+    """
+    sinfo -o output for the given columns, identical rows merged as sinfo does.
+    """
+    lines = ['|'.join(columns)]
+    seen = set()
+    for node in cluster['nodes']:
+        line = '|'.join(node[c] for c in columns)
+        if line not in seen:
+            seen.add(line)
+            lines.append(line)
+    return lines
+
+
+def sacct_lines(cluster, fields, states=('RUNNING',)):
+    lines = ['|'.join(fields)]
+    for job in cluster['jobs']:
+        if job['State'] in states:
+            lines.append('|'.join(job[f] for f in fields))
+    return lines
+
+
+def get_sacct_fields(cmd):
+    return [arg[2:] for arg in cmd if arg.startswith('-o')][0].split(',')
+
+
+def write_replay(cluster, out_dir, oc):
+    """
+    Record every query orwell-cli.py (oc, for any --show and filters) and
+    queue-summary.py can make of cluster into out_dir.
+    """
+    slurm_io.capture_settings['record'] = out_dir
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    column_of = dict((field, column) for column, field in oc.sinfo_fields.items())
+    sinfo_cmds, sacct_cmds = set(), set()
+    # every combination of --show and filters plan_queries tells apart
+    for show, node_filts, job_filts, extra in product(['cpu', 'ram', 'both', 'job'],
+                                                      product([[], ['partition']], [[], ['feature']]),
+                                                      product([[], ['user']], [[], ['account']], [[], ['job_partition']]),
+                                                      product([[], ['STATE']], [[], ['PARTITION']])):
+        filters = dict((f, ['x']) for f in sum(node_filts, []) + sum(job_filts, []) + ['job_id'])
+        plan = oc.plan_queries(show, filters, sum(extra, []))
+        sinfo_cmds.add(tuple(plan['sinfo']))
+        sacct_cmds.add(tuple(plan['sacct']))
+    queries = {}
+    for cmd in sinfo_cmds:
+        queries[cmd] = sinfo_lines(cluster, [column_of[f] for f in cmd[-1].split('=', 1)[1].split('|')])
+    for cmd in sacct_cmds:
+        queries[cmd] = sacct_lines(cluster, get_sacct_fields(cmd))
+    queries[tuple(oc.sinfo_parts_cmd)] = sorted(set(n['PARTITION'].replace('general', 'general*')
+                                                    for n in cluster['nodes']))
+    queries[tuple(oc.sinfo_feats_cmd)] = sorted(set(n['AVAIL_FEATURES'] for n in cluster['nodes']))
+    queries[tuple(oc.slurm_conf_cmd)] = ['Configuration data as of 2020-01-01T00:00:00',
+                                         'SLURM_CONF              = {}'.format(slurm_conf)]
+    queries[tuple(oc.slurm_dir_key)] = [os.path.dirname(slurm_conf)]
+    queries[tuple(queue_sacct_cmd)] = sacct_lines(cluster, get_sacct_fields(queue_sacct_cmd),
+                                                  ('RUNNING', 'PENDING', 'REQUEUED'))
+    for cmd, lines in queries.items():
+        slurm_io.captured_lines(list(cmd), lambda: lines)
+    slurm_io._record(['file', os.path.join(os.path.dirname(slurm_conf), 'gres.conf')], cluster['gres'])
+    slurm_io.capture_settings['record'] = None
+
+
+def add_cluster_args(parser):
+    parser.add_argument('--scheme', default='chassis', choices=schemes, help='Node naming. Default: chassis')
+    parser.add_argument('--array-density', type=float, default=0.5,
+                        help='Fraction of jobs that are array jobs. Default: 0.5')
+    parser.add_argument('--gpu-fraction', type=float, default=0.1,
+                        help='Fraction of nodes (and jobs) with gpus. Default: 0.1')
+    parser.add_argument('--gpu-mix', default='k80:1,v100:1',
+                        help='Gpu types and their weights. Default: k80:1,v100:1')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. Default: 0')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('out_dir', help='Directory to write, to use with --replay')
+    parser.add_argument('-n', '--nodes', type=int, default=10000, help='Nodes to generate. Default: 10000')
+    parser.add_argument('-j', '--jobs', type=int, default=100000, help='Jobs to generate. Default: 100000')
+    add_cluster_args(parser)
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = get_args()
+    cluster = gen_cluster(args['nodes'], args['jobs'], args['scheme'], args['array_density'],
+                          args['gpu_fraction'], args['gpu_mix'], args['seed'])
+    write_replay(cluster, args['out_dir'], load_script('orwell-cli.py'))
+    print('{} nodes, {} jobs written to {}'.format(args['nodes'], len(cluster['jobs']), args['out_dir']))
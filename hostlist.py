@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Slurm hostlist expressions, e.g. c[01-04]n[01-32],gpu[01,03]: expansion
+(cached, or lazy for huge ranges) and compression of host names back into one.
+"""
+from __future__ import unicode_literals
+import re
+import threading
+from itertools import product
+from collections import OrderedDict as od
+
+
+# Constants
+# how many distinct hostlists to keep expanded
+cache_size = 4096
+# hostlists expanding to more hosts than this aren't cached
+cache_max_hosts = 65536
+# text between brackets, and a host name ending in a number
+bracket_regex = re.compile(r'\[([^\[\]]*)\]')
+host_regex = re.compile(r'^(.*?)(\d+)(\D*)$')
+
+_cache = od()
+_cache_lock = threading.Lock()
+
+
+def _split_pieces(hostlist):
+    # split on commas outside of brackets
+    depth = start = 0
+    for i, c in enumerate(hostlist):
+        if c == '[':
+            depth += 1
+        elif c == ']':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            yield hostlist[start:i]
+            start = i + 1
+    yield hostlist[start:]
+
+
+def _parse_piece(piece):
+    """
+    Split a piece like c[01-04]n[01,03] into its literal text and its bracketed
+    ranges: ['c', 'n', ''] and [[(1, 4, 2)], [(1, 1, 2), (3, 3, 2)]].
+    """
+    parts = bracket_regex.split(piece)
+    literals, brackets = parts[0::2], parts[1::2]
+    if any('[' in l or ']' in l for l in literals):
+        raise ValueError('Unbalanced brackets in hostlist: {}'.format(piece))
+    ranges = []
+    for bracket in brackets:
+        bracket_ranges = []
+        for sub_range in bracket.split(','):
+            lo, _, hi = sub_range.partition('-')
+            if not lo.isdigit() or not (hi or lo).isdigit():
+                raise ValueError('Bad range in hostlist: {}'.format(piece))
+            # slurm pads every number in a range to the width of the low end
+            bracket_ranges.append((int(lo), int(hi or lo), len(lo)))
+        ranges.append(bracket_ranges)
+    return literals, ranges
+
+
+def _iter_range(bracket_ranges):
+    for lo, hi, width in bracket_ranges:
+        for i in range(lo, hi + 1):
+            yield '%0*d' % (width, i)
+
+
+def _iter_piece(literals, ranges, prefix=''):
+    if len(ranges) == 0:
+        yield prefix + literals[0]
+        return
+    for number in _iter_range(ranges[0]):
+        for host in _iter_piece(literals[1:], ranges[1:], prefix + literals[0] + number):
+            yield host
+
+
+def iter_hostlist(hostlist):
+    """
+    Yield the hosts in hostlist one at a time, without holding them all, for
+    ranges too big to expand at once.
+    """
+    for piece in _split_pieces(hostlist):
+        literals, ranges = _parse_piece(piece)
+        for host in _iter_piece(literals, ranges):
+            yield host
+
+
+def _expand(hostlist):
+    hosts = []
+    for piece in _split_pieces(hostlist):
+        literals, ranges = _parse_piece(piece)
+        if len(ranges) == 0:
+            hosts.append(piece)
+        elif len(ranges) == 1:
+            prefix, suffix = literals
+            hosts.extend([prefix + number + suffix for number in _iter_range(ranges[0])])
+        else:
+            # cartesian product, leftmost bracket varying slowest
+            numbers = [list(_iter_range(bracket_ranges)) for bracket_ranges in ranges]
+            for combo in product(*numbers):
+                hosts.append(''.join(l + n for l, n in zip(literals, combo + ('',))))
+    return tuple(hosts)
+
+
+def expand_hostlist(hostlist):
+    """
+    All hosts in hostlist, in order, as a tuple. Recently expanded hostlists
+    are kept, since the same NodeList turns up over and over.
+    """
+    with _cache_lock:
+        hosts = _cache.pop(hostlist, None)
+        if hosts is not None:
+            # put it back as most recently used
+            _cache[hostlist] = hosts
+            return hosts
+    hosts = _expand(hostlist)
+    if len(hosts) <= cache_max_hosts:
+        with _cache_lock:
+            _cache[hostlist] = hosts
+            while len(_cache) > cache_size:
+                _cache.popitem(last=False)
+    return hosts
+
+
+def _format_range(numbers):
+    """
+    Turn sorted (int, str) pairs into 'a-b,c' runs that expand back into exactly
+    the same strings, padding included.
+    """
+    runs = []
+    for value, text in numbers:
+        if len(runs) > 0:
+            start_text, last_value = runs[-1]
+            if value == last_value + 1 and '%0*d' % (len(start_text), value) == text:
+                runs[-1] = (start_text, value)
+                continue
+        runs.append((text, value))
+    return ','.join(start if int(start) == end else '{}-{:0{}d}'.format(start, end, len(start))
+                    for start, end in runs)
+
+
+def _compress_pieces(hosts):
+    # group on everything but the last number, then compress the groups' prefixes the same way
+    groups = od()
+    literal = []
+    for host in hosts:
+        match = host_regex.match(host)
+        if match is None:
+            literal.append(host)
+            continue
+        prefix, number, suffix = match.groups()
+        groups.setdefault((prefix, suffix), set()).add((int(number), number))
+
+    by_range = od()
+    for (prefix, suffix), numbers in groups.items():
+        numbers = sorted(numbers)
+        body = _format_range(numbers)
+        if len(numbers) > 1:
+            body = '[{}]'.format(body)
+        by_range.setdefault((body, suffix), []).append(prefix)
+
+    pieces = list(literal)
+    for (body, suffix), prefixes in by_range.items():
+        for prefix in _compress_pieces(prefixes) if len(prefixes) > 1 else prefixes:
+            pieces.append(prefix + body + suffix)
+    return pieces
+
+
+def _natural_key(piece):
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', piece)]
+
+
+def compress_hostlist(hosts):
+    """
+    The shortest-ish hostlist expression for a collection of hosts, the reverse
+    of expand_hostlist: compress_hostlist(expand_hostlist('c[01-02]n[01-32]')) == 'c[01-02]n[01-32]'
+    """
+    return ','.join(sorted(_compress_pieces(set(hosts)), key=_natural_key))
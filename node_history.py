@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Node utilization history: each collection's per node state, cpu and ram usage
+appended as one fixed-width, columnar frame to a binary file, and read back by
+memory mapping it, so any past frame can be found and drawn without loading
+the rest.
+
+FILE holds the frames: a byte of state code for each node, then one of cpu and
+one of ram usage, nodes in the order they were first seen. FILE.idx holds a
+fixed size (time, offset, nodes) record per frame, to binary search on time.
+FILE.nodes is the stable node index and state codes, as json.
+"""
+from __future__ import unicode_literals
+import io
+import os
+import json
+import mmap
+import time
+import fcntl
+import struct
+import bisect
+
+
+# Constants
+# one index record: unix time, where the frame starts in FILE, how many nodes it has
+index_record = struct.Struct('<dQQ')
+# usages are stored in half hundredths: exact hundredths as themselves, anything
+# between two as halfway, so they're closest to the same glyph when read back.
+# usage_unknown when we didn't have them
+usage_scale = 100
+usage_unknown = 255
+# state code 0 is a node missing from that frame
+missing_state = None
+
+
+def get_paths(history_path):
+    return {'frames': history_path, 'index': history_path + '.idx', 'nodes': history_path + '.nodes'}
+
+
+def _read_nodes(nodes_path):
+    if not os.path.isfile(nodes_path):
+        return {'nodes': [], 'states': [missing_state]}
+    with io.open(nodes_path, encoding='utf-8') as nodes_file:
+        return json.load(nodes_file)
+
+
+def _write_nodes(nodes_path, known):
+    # replaced whole, so readers never see half of it
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(nodes_path)), prefix='.nodes-')
+    with os.fdopen(fd, 'wb') as nodes_file:
+        nodes_file.write(json.dumps(known).encode('utf-8'))
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, nodes_path)
+
+
+def _usage_byte(usage):
+    if usage is None:
+        return usage_unknown
+    hundredths = min(usage_scale, max(0, usage * usage_scale))
+    if abs(hundredths - round(hundredths)) < 1e-9:
+        return 2 * int(round(hundredths))
+    return 2 * int(hundredths) + 1
+
+
+def _byte_usage(value):
+    if value == usage_unknown:
+        return None
+    return value / (2.0 * usage_scale)
+
+
+def append_frame(history_path, nodes, states, cpu_usage, mem_usage, when=None):
+    """
+    Append one frame: nodes' states and usages (None where unknown) at when,
+    default now. Nodes not seen before are added to the end of the index.
+    """
+    paths = get_paths(history_path)
+    with open(paths['index'], 'ab') as index_file:
+        # one writer at a time, from here until the index record is written
+        fcntl.flock(index_file, fcntl.LOCK_EX)
+        known = _read_nodes(paths['nodes'])
+        node_codes = dict((name, i) for i, name in enumerate(known['nodes']))
+        state_codes = dict((state, i) for i, state in enumerate(known['states']))
+        added = False
+        for node, state in zip(nodes, states):
+            if node not in node_codes:
+                node_codes[node] = len(known['nodes'])
+                known['nodes'].append(node)
+                added = True
+            if state not in state_codes:
+                state_codes[state] = len(known['states'])
+                known['states'].append(state)
+                added = True
+        if len(known['states']) > 256:
+            raise ValueError('More than 256 node states in {}'.format(paths['nodes']))
+        if added:
+            _write_nodes(paths['nodes'], known)
+
+        n_nodes = len(known['nodes'])
+        frame = bytearray(3 * n_nodes)
+        frame[n_nodes:] = bytearray([usage_unknown]) * (2 * n_nodes)
+        for i, node in enumerate(nodes):
+            code = node_codes[node]
+            frame[code] = state_codes[states[i]]
+            frame[n_nodes + code] = _usage_byte(cpu_usage[i] if cpu_usage is not None else None)
+            frame[2 * n_nodes + code] = _usage_byte(mem_usage[i] if mem_usage is not None else None)
+        # the frame goes in before the index points at it
+        with open(paths['frames'], 'ab') as frames_file:
+            offset = frames_file.tell()
+            frames_file.write(frame)
+        index_file.write(index_record.pack(time.time() if when is None else when, offset, n_nodes))
+
+
+class _Times(object):
+    # the index's times as a sequence, for bisect
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index) // index_record.size
+
+    def __getitem__(self, i):
+        return index_record.unpack_from(self.index, i * index_record.size)[0]
+
+
+class NodeHistory(object):
+    """
+    A history file memory mapped for reading. Frames are numbered from 0, oldest first.
+    """
+    def __init__(self, history_path):
+        paths = get_paths(history_path)
+        if not os.path.isfile(paths['index']) or os.path.getsize(paths['index']) < index_record.size:
+            raise IOError('No history in {}'.format(history_path))
+        self._files = [open(paths['index'], 'rb'), open(paths['frames'], 'rb')]
+        self.index, self.frames = [mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) for f in self._files]
+        self.times = _Times(self.index)
+        # nodes are written before the frames that have them, so this knows every mapped frame's nodes
+        known = _read_nodes(paths['nodes'])
+        self.nodes, self.states = known['nodes'], known['states']
+
+    def __len__(self):
+        return len(self.times)
+
+    def close(self):
+        for mapped in [self.index, self.frames] + self._files:
+            mapped.close()
+
+    def find(self, when):
+        # the last frame at or before when, or the first one if they're all after it
+        return max(0, bisect.bisect_right(self.times, when) - 1)
+
+    def read(self, i):
+        """
+        Frame i as its time and nodes, states, cpu and ram usages (None if unknown)
+        of the nodes in it.
+        """
+        when, offset, n_nodes = index_record.unpack_from(self.index, i * index_record.size)
+        frame = bytearray(self.frames[offset:offset + 3 * n_nodes])
+        nodes, states, cpu_usage, mem_usage = [], [], [], []
+        for code in range(n_nodes):
+            if frame[code] == 0:
+                continue
+            nodes.append(self.nodes[code])
+            states.append(self.states[frame[code]])
+            for usage, value in [(cpu_usage, frame[n_nodes + code]), (mem_usage, frame[2 * n_nodes + code])]:
+                usage.append(_byte_usage(value))
+        return when, nodes, states, cpu_usage, mem_usage
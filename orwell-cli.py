@@ -4,15 +4,22 @@ from __future__ import print_function
 from __future__ import unicode_literals
 import re
 import sys
-import string
+import time
 import argparse
-import subprocess
-from os import path, access, R_OK
-from textwrap import wrap
+import threading
+import unicodedata
+from os import path, stat, environ
 from collections import defaultdict as dd
 from collections import OrderedDict as od
-from itertools import chain, cycle
+from itertools import chain, cycle, repeat
 from bisect import bisect_left
+try:
+    from shutil import get_terminal_size
+except ImportError:
+    # python 2
+    get_terminal_size = None
+import slurm_io
+import hostlist
 
 
 # Constants
@@ -22,15 +29,47 @@ colors = dict(black='30', blue='34', cyan='36', green='32', magenta='35',
 # kinds of output
 char_types = ['ascii', 'utf8', 'emoji']
 # sinfo and sacct commands
-sinfo_cmd = ['sinfo', '--format=%all', '-a']
 sinfo_parts_cmd = ['sinfo', '--format=%P', '-ha']
 sinfo_feats_cmd = ['sinfo', '-ha', '--format=%f']
-sacct_cmd = ['sacct', '-XaPsR', '-oJobID,JobName,User,Account,NodeList,Partition']
-# split slurm output with  slurm_delim
-slurm_delim = r' ?\|'
-# regexes to match node names
-node_regex = re.compile('(\D+)(\d+)n?(\d*)')
-gpu_regex = re.compile('NodeName=([a-zA-Z\d\[\],\-]+).+Type=([\w\d]+)\W+.*')
+sinfo_gres_cmd = ['sinfo', '-ha', '--format=%G']
+# the sinfo columns we read and the --format field for each, see plan_queries
+sinfo_fields = od([('HOSTNAMES', '%n'), ('STATE', '%T'), ('CPUS(A/I/O/T)', '%C'), ('FREE_MEM', '%e'),
+                   ('MEMORY', '%m'), ('PARTITION', '%R'), ('AVAIL_FEATURES', '%f'), ('GRES', '%G')])
+sacct_fields = ['JobID', 'JobName', 'User', 'Account', 'NodeList', 'Partition']
+# what a Job keeps of them
+job_fields = ['JobID', 'JobName', 'User', 'Account', 'Partition']
+slurm_conf_cmd = ['sacctmgr', 'show', 'configuration']
+# seconds to wait on any one slurm command before giving up on it
+slurm_timeout = 30
+# seconds to trust where sacctmgr said slurm.conf is, it hardly ever moves
+slurm_conf_ttl = 24 * 60 * 60
+# seconds between polls when running as a collector
+poll_interval = 30
+# node attributes and job fields nodes can be highlighted on
+node_filters = ['partition', 'feature', 'gpu_type']
+job_filters = ['job_partition', 'user', 'account']
+# wrap --help text this wide
+help_width = 70
+# seconds between frames of --replay-range, unless --watch says otherwise
+replay_delay = 0.5
+# what the machine readable --output formats include for each node, and the prometheus metrics
+node_fields = ['cluster', 'node', 'state', 'cpu_usage', 'mem_usage', 'partitions', 'features', 'gpu_types', 'jobs']
+node_metrics = od([('cpu_usage', "Fraction of the node's CPUs allocated."),
+                   ('mem_usage', "Fraction of the node's memory in use."),
+                   ('jobs', 'Jobs running on the node.')])
+# what labels the prometheus node gauges, and what only orwell_node_info carries
+node_metric_labels = ['cluster', 'node']
+node_info_labels = ['partitions', 'features', 'gpu_types']
+# below this many nodes quantizing in plain python beats importing numpy (~0.1s)
+numpy_min_nodes = 200000
+# how to split node names into the chassis (row) and number (column) they're shown at,
+# tried in order after any --node-pattern. c13n05: chassis c13, node 5. gpu02: chassis gpu, node 2
+node_patterns = [re.compile(r'^(?P<chassis>\D+\d+)n(?P<num>\d+)$'),
+                 re.compile(r'^(?P<chassis>.*\D)(?P<num>\d+)$')]
+# color escapes highlight_node puts around glyphs
+ansi_regex = re.compile(r'\x1b\[[0-9;]*m')
+# regex to match node names and gpu types in gres.conf, compiled only when it's read
+gpu_regex = r'NodeName=([a-zA-Z\d\[\],\-]+).+Type=([\w\d]+)\W+.*'
 
 
 def get_help():
@@ -42,13 +81,19 @@ A utility to view slurm node status and usage.
 """)
 
 
-def _wrap(s, n):
-    return '\n'.join(wrap(s, n))
+class HelpFormatter(argparse.RawTextHelpFormatter):
+    """
+    Help text as written, long lines wrapped to help_width. Wrapping waits until
+    --help is printed so that other runs don't import textwrap.
+    """
+    def _split_lines(self, text, width):
+        from textwrap import wrap
+        return [wrapped for line in text.splitlines() for wrapped in wrap(line, help_width) or ['']]
 
 
 def get_args():
     parser = argparse.ArgumentParser(description=get_help(), prog='orwell-cli',
-                                     formatter_class=argparse.RawTextHelpFormatter)
+                                     formatter_class=HelpFormatter)
 
     general_args = parser.add_argument_group('General Options')
     general_args.add_argument('-l', '--legend',
@@ -66,11 +111,41 @@ def get_args():
                               default='cpu',
                               metavar='cpu|ram|both',
                               choices=['cpu', 'ram', 'both', 'job'],
-                              help=_wrap(('Show proportion of allocated CPUs, RAM, both, or job layout. ' +
-                                          'Order when displaying proportion of both is CPU, RAM. ' +
-                                          'Showing job will assign a glyph to each job and display the ' +
-                                          'last job  running on each node. Makes the most sense on clusters ' +
-                                          'with exclusive node allocation.'), 70))
+                              help=('Show proportion of allocated CPUs, RAM, both, or job layout. ' +
+                                    'Order when displaying proportion of both is CPU, RAM. ' +
+                                    'Showing job will assign a glyph to each job and display the ' +
+                                    'last job  running on each node. Makes the most sense on clusters ' +
+                                    'with exclusive node allocation.'))
+    general_args.add_argument('-w', '--watch',
+                              type=float,
+                              metavar='seconds',
+                              help=('Stay running and refresh the node layout every this many seconds, ' +
+                                    'redrawing only the rows that changed. Ctrl-C to quit.'))
+    general_args.add_argument('-n', '--node-pattern',
+                              metavar='regex',
+                              action='append',
+                              help=('How to lay out node names that don\'t look like c01n01 or gpu01: a ' +
+                                    'regex with (?P<chassis>...) and (?P<num>...) groups for the row and ' +
+                                    'column each node is shown at. Can be given more than once.'))
+    general_args.add_argument('-z', '--zoom-out',
+                              action='store_true',
+                              help=('Summarize the layout to fit the terminal: one line per chassis, or ' +
+                                    'group of chassis, with node count, mean and max usage, idle and down ' +
+                                    'nodes, and how many nodes match the filters.'))
+    general_args.add_argument('-C', '--chassis',
+                              metavar='chassis',
+                              action='append',
+                              help='Only show the given chassis (the row names), comma separated')
+    general_args.add_argument('--only-partition',
+                              metavar='partition',
+                              action='append',
+                              help='Only show nodes in the given partition(s), comma separated')
+    general_args.add_argument('-o', '--output',
+                              default='grid',
+                              choices=['grid'] + slurm_io.output_formats,
+                              help=('Print every node\'s state, cpu and ram usage, partitions, features, ' +
+                                    'gpu types and jobs as ndjson, csv or prometheus metrics instead of ' +
+                                    'the grid. With --watch, again every refresh. Default: grid'))
     general_args.add_argument('-c', '--color',
                               default='red',
                               choices=colors.keys(),
@@ -104,13 +179,63 @@ def get_args():
     job_args.add_argument('-A', '--account',
                           action='append',
                           help='Highlight nodes where the given account(s) are running jobs, comma separated')
+
+    slurm_args = parser.add_argument_group('Slurm Options')
+    slurm_args.add_argument('-t', '--timeout',
+                            default=slurm_timeout,
+                            type=float,
+                            metavar='seconds',
+                            help='Give up on any one slurm command after this many seconds. Default: {}'.format(slurm_timeout))
+    slurm_args.add_argument('-M', '--clusters',
+                            metavar='cluster',
+                            action='append',
+                            help=('Show each of the given cluster(s), comma separated, one after the other. ' +
+                                  'They are queried at the same time, and one that times out or fails is ' +
+                                  'skipped with a warning.'))
+    slurm_io.add_cache_args(parser)
+    slurm_io.add_capture_args(parser)
+    slurm_io.add_diagnostic_args(parser)
+
+    collector_args = parser.add_argument_group('Collector Options')
+    collector_args.add_argument('--serve',
+                                action='store_true',
+                                help=('Run as a collector: poll slurm once per interval and answer other ' +
+                                      'orwell-cli and queue-summary runs from memory over the unix socket ' +
+                                      '$ORWELL_SOCKET, default {}. They query slurm directly when no ' +
+                                      'collector is running. Every local user can ask it for any job, so it ' +
+                                      'refuses to run as root or SlurmUser. Deploy it as a service running as ' +
+                                      'an unprivileged account, and set $ORWELL_COLLECTOR_USER to that account ' +
+                                      'for every user (e.g. in /etc/profile.d): runs only trust a socket owned ' +
+                                      'by it, themselves or root.').format(slurm_io.collector_socket))
+    collector_args.add_argument('--poll-interval',
+                                default=poll_interval,
+                                type=float,
+                                metavar='seconds',
+                                help='How often a collector polls slurm. Default: {}'.format(poll_interval))
+    slurm_io.add_exporter_args(parser, poll_interval)
+
+    history_args = parser.add_argument_group('History Options')
+    history_args.add_argument('--history',
+                              metavar='FILE',
+                              help=('Append every node\'s state and cpu and ram usage to FILE (FILE-cluster ' +
+                                    'with -M) each time slurm is queried, e.g. with --watch or --exporter. ' +
+                                    'With --at or --replay-range, read them back instead.'))
+    history_args.add_argument('--at',
+                              metavar='TIME',
+                              help=('Draw the nodes as they were at TIME (YYYY-MM-DD[THH:MM[:SS]]), from ' +
+                                    '--history FILE rather than slurm. Partitions, features, gpus and ' +
+                                    'jobs aren\'t recorded, so filtering on them highlights nothing.'))
+    history_args.add_argument('--replay-range',
+                              metavar='START,END',
+                              help=('Play back every frame in --history FILE from START to END, one every ' +
+                                    '--watch seconds, default {}.').format(replay_delay))
     return vars(parser.parse_args())
 
 
 def get_filters(args):
     filters = dd(lambda: [])
 
-    for filt in ['partition', 'feature', 'gpu_type', 'job_id', 'job_partition', 'user', 'account']:
+    for filt in node_filters + ['job_id'] + job_filters:
         if args[filt] is not None:
             for csv in args[filt]:
                 items = csv.split(',')
@@ -118,21 +243,71 @@ def get_filters(args):
     return filters
 
 
-def get_subprocess_lines(cmd):
-    try:
-        pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        for line in pipe.stdout:
-            yield line.decode().strip()
-        pipe.wait()
-    except OSError as e:
-        print("Couldn't find slurm commands. Are you sure you're on a slurm cluster?")
-        sys.exit(1)
+def get_sinfo_cmd(columns, cluster=None):
+    return slurm_io.get_cluster_cmd(['sinfo', '-a', '--format=' + '|'.join(sinfo_fields[c] for c in columns)], cluster)
+
+
+def get_sacct_cmd(fields, cluster=None):
+    return slurm_io.get_cluster_cmd(['sacct', '-XaPsR', '-o' + ','.join(fields)], cluster)
+
+
+def plan_queries(show_usage, filters, extra_columns=(), cluster=None):
+    """
+    Work out which slurm commands, and which of their columns, --show and the
+    filters need, so we don't make slurm produce (or ourselves parse) the rest.
+    extra_columns are sinfo columns needed for other reasons, like --zoom-out.
+    Another cluster's gres.conf isn't ours to read, its gpus come from sinfo.
+    """
+    columns = ['HOSTNAMES']
+    if show_usage != 'job':
+        columns.append('STATE')
+    if show_usage in ['cpu', 'both']:
+        columns.append('CPUS(A/I/O/T)')
+    if show_usage in ['ram', 'both']:
+        columns += ['FREE_MEM', 'MEMORY']
+    if 'partition' in filters:
+        columns.append('PARTITION')
+    if 'feature' in filters:
+        columns.append('AVAIL_FEATURES')
+    if 'gpu_type' in filters and cluster is not None:
+        columns.append('GRES')
+    # in sinfo_fields order, so the same columns always make the same command
+    columns = [c for c in sinfo_fields if c in columns or c in extra_columns]
+
+    plan = {'sinfo': get_sinfo_cmd(columns, cluster), 'sacct': None, 'gres': 'gpu_type' in filters and cluster is None}
+    if show_usage == 'job' or any(f in filters for f in ['job_id'] + job_filters):
+        fields = ['JobID', 'NodeList']
+        fields += [field for filt, field in [('user', 'User'), ('account', 'Account'),
+                                             ('job_partition', 'Partition')] if filt in filters]
+        plan['sacct'] = get_sacct_cmd(fields, cluster)
+    return plan
+
+
+# slurm config directory once found, see get_slurm_dir, and the name it's recorded under
+_slurm_dir = {}
+slurm_dir_key = ['slurm-dir']
+
+
+@slurm_io.timed
+def get_slurm_dir(timeout=None):
+    """
+    Where slurm.conf and gres.conf live: from $SLURM_CONF if set, else from
+    sacctmgr, which is slow so its answer is kept for a day. Recorded as found,
+    so a replay reads the same files whichever way the recording found them.
+    """
+    if 'dir' not in _slurm_dir:
+        found = slurm_io.captured_lines(slurm_dir_key, lambda: find_slurm_dir(timeout))
+        _slurm_dir['dir'] = found[0] if len(found) > 0 else None
+    return _slurm_dir['dir']
 
 
-def get_slurm_dir():
-    for line in get_subprocess_lines(['sacctmgr', 'show', 'configuration']):
+def find_slurm_dir(timeout=None):
+    if environ.get('SLURM_CONF'):
+        return [path.dirname(environ['SLURM_CONF'])]
+    for line in slurm_io.get_subprocess_lines(slurm_conf_cmd, timeout, cache=True, cache_ttl=slurm_conf_ttl):
         if line.startswith('SLURM_CONF'):
-            return path.dirname(line.split()[2])
+            return [path.dirname(line.split()[2])]
+    return []
 
 
 # rest of functions
@@ -141,17 +316,27 @@ def get_pad(list_of_things):
 
 
 def gen_job_glyphs(char_type):
+    """
+    Glyphs to hand out to jobs, over and over. The table is only built once the
+    first job asks for one, runs that don't draw jobs never build it.
+    """
+    for glyph in cycle(get_job_glyph_table(char_type)):
+        yield glyph
+
+
+def get_job_glyph_table(char_type):
+    import string
     if char_type == 'ascii':
-        return cycle(string.ascii_letters + string.digits)
+        return string.ascii_letters + string.digits
     elif char_type == 'utf8':
-        return cycle(
+        return (
             string.ascii_letters + string.digits +
             '𝔸𝔹ℂ𝔻𝔼𝔽𝔾ℍ𝕀𝕁𝕂𝕃𝕄ℕ𝕆ℙℚℝ𝕊𝕋𝕌𝕍𝕎𝕏𝕐ℤ𝟙𝟚𝟛𝟜𝟝𝟞𝟟𝟠𝟡𝟘' +
             '🅐🅑🅒🅓🅔🅕🅖🅗🅘🅙🅚🅛🅜🅝🅞🅟🅠🅡🅢🅣🅤🅥🅦🅧🅨🅩❶❷❸❹❺❻❼❽❾⓿' +
             '🄰🄱🄲🄳🄴🄵🄶🄷🄸🄹🄺🄻🄼🄽🄾🄿🅀🅁🅂🅃🅄🅅🅆🅇🅈🅉1234567890'
         )
     elif char_type == 'emoji':
-        return cycle(
+        return (
             '⌚⌛⌨⏏⏩⏪⏫⏬⏭⏮⏯⏰⏱⏲⏳⏸⏹⏺Ⓜ▪▫▶◀◻◼◽◾☀☁☂☃☄☎☑☔☕☘☢☣☦☪☮☯☸☹☺♀♂♈♉♊♋♌♍♎♏♐♑♒♓' +
             '♠♣♥♦♨♻♿⚒⚓⚔⚕⚖⚗⚙⚛⚜⚠⚡⚪⚫⚰⚱⚽⚾⛄⛅⛈⛎⛏⛑⛓⛔⛩⛪⛰⛱⛲⛳⛴⛵⛸⛺⛽✂✅✈✉✏✒✔✖✝✡✨✳✴❄❇❌❎' +
             '❓❔❕❗❣❤➕➖➗➡➰➿⤴⤵⬅⬆⬇⬛⬜⭐⭕〰〽㊗㊙🀄🃏🅰🅱🅾🅿🆎🆑🆒🆓🆔🆕🆖🆗🆘🆙🆚🇦🇧🇨🇩🇪🇫🇬🇭🇮🇯🇰🇱🇲🇳🇴🇵🇶🇷' +
@@ -234,15 +419,73 @@ def get_closest(nums, my_num):
         return before
 
 
-def get_node_glyph(state, usage, state_glyphs, usage_glyphs):
+def get_state_kind(state):
     if state.startswith('mix') or state.startswith('alloc'):
-        return usage_glyphs[get_closest(usage_glyphs.keys(), usage)]
+        return 'in use'
     if state.startswith('idle'):
-        return state_glyphs['idle']
+        return 'idle'
     if state.startswith('reserv'):
-        return state_glyphs['reserved']
+        return 'reserved'
     else:
-        return state_glyphs['down']
+        return 'down'
+
+
+def get_state_glyph(state, state_glyphs):
+    """
+    The glyph for a node in state, or None if it's in use and gets a usage glyph.
+    """
+    kind = get_state_kind(state)
+    if kind == 'in use':
+        return None
+    return state_glyphs[kind]
+
+
+def get_node_glyph(state, usage, state_glyphs, usage_glyphs):
+    glyph = get_state_glyph(state, state_glyphs)
+    if glyph is None:
+        return usage_glyphs[get_closest(list(usage_glyphs.keys()), usage)]
+    return glyph
+
+
+def quantize_usage(usages, thresholds):
+    """
+    For each usage, the index of the closest of the sorted thresholds, the smaller
+    one if two are equally close, exactly as get_closest picks them.
+    """
+    last = len(thresholds) - 1
+    numpy = slurm_io.get_numpy() if len(usages) >= numpy_min_nodes else None
+    if numpy is not None:
+        nums = numpy.asarray(thresholds, dtype=float)
+        values = numpy.asarray(usages, dtype=float)
+        pos = numpy.searchsorted(nums, values, side='left')
+        before = numpy.maximum(pos - 1, 0)
+        after = numpy.minimum(pos, last)
+        closest = numpy.where(nums[after] - values < values - nums[before], after, before)
+        # past either end there's only one candidate
+        closest = numpy.where(pos == 0, 0, numpy.where(pos > last, last, closest))
+        return closest.tolist()
+    closest = []
+    for usage in usages:
+        pos = bisect_left(thresholds, usage)
+        if pos == 0 or pos > last:
+            closest.append(min(pos, last))
+        elif thresholds[pos] - usage < usage - thresholds[pos - 1]:
+            closest.append(pos)
+        else:
+            closest.append(pos - 1)
+    return closest
+
+
+def get_node_glyphs(states, usages, state_glyphs, usage_glyphs):
+    """
+    get_node_glyph for many nodes at once: each distinct state is looked up once,
+    and the usage of all nodes in use is quantized in one pass.
+    """
+    state_table = dict((state, get_state_glyph(state, state_glyphs)) for state in set(states))
+    in_use = [usage for state, usage in zip(states, usages) if state_table[state] is None]
+    chars = list(usage_glyphs.values())
+    usage_chars = iter([chars[i] for i in quantize_usage(in_use, list(usage_glyphs.keys()))])
+    return [next(usage_chars) if state_table[state] is None else state_table[state] for state in states]
 
 
 def print_legend(show_usage, state_glyphs, usage_glyphs):
@@ -262,78 +505,149 @@ def print_legend(show_usage, state_glyphs, usage_glyphs):
     print('{}^1%{}100%^\n'.format(' ' * len(nu), ' ' * (len(usage_glyphs.keys()) * 2 - 7)))
 
 
-def expand_node_list(node_list):
-    return chain.from_iterable(_expand_hostlist(node_list))
+def add_node_patterns(patterns):
+    # user patterns go first so they can override ours
+    compiled = []
+    for pattern in patterns:
+        try:
+            regex = re.compile(pattern)
+        except re.error as e:
+            sys.exit('Bad node pattern {}: {}'.format(pattern, e))
+        if not set(['chassis', 'num']).issubset(regex.groupindex):
+            sys.exit('Node pattern {} needs (?P<chassis>...) and (?P<num>...) groups'.format(pattern))
+        compiled.append(regex)
+    node_patterns[:0] = compiled
 
 
-def _expand_hostlist(node_list):
-    in_bracket = p_beg = p_end = 0
-    for i, c in enumerate(node_list):
-        if not in_bracket and c == ',':
-            yield _expand_part(node_list[p_beg:p_end])
-            p_beg, p_end = i + 1, i
-        p_end += 1
-        in_bracket += int(c == '[') + -1 * int(c == ']')
-    yield _expand_part(node_list[p_beg:p_end])
+def split_node_name(node_name):
+    for pattern in node_patterns:
+        node_match = pattern.match(node_name)
+        if node_match is not None and node_match.group('num').isdigit():
+            return node_match.group('chassis'), int(node_match.group('num'))
+    # a name we can't split gets a row to itself
+    return node_name, 1
 
 
-def _expand_part(p):
-    if '[' in p:
-        r_beg, r_end, prefix = p.index('['), p.index(']'), p[:p.index('[')]
-        for sub_r in p[r_beg + 1:r_end].split(','):
-            if '-' not in sub_r:
-                yield prefix + sub_r
-            else:
-                lo, hi = sub_r.split('-', 1)
-                for i in range(int(lo), int(hi) + 1):
-                    yield prefix + str(i).zfill(len(lo))
-    else:
-        yield p
+def read_gres_conf(gres_conf, sources):
+    """
+    Lines of gres_conf and the files it Includes, in order. sources gets the
+    mtime and size of every file read and None for Includes that can't be, or
+    is left empty if gres_conf can't be.
+    """
+    lines = slurm_io.read_file_lines(gres_conf)
+    if lines is None:
+        return []
+    try:
+        file_stat = stat(gres_conf)
+        sources[gres_conf] = [file_stat.st_mtime, file_stat.st_size]
+    except OSError:
+        # never matches, so the index is read again next time
+        sources[gres_conf] = [None, None]
+    gres_lines = []
+    for line in lines:
+        words = line.split()
+        if len(words) == 2 and words[0].lower() == 'include':
+            # relative includes are relative to the including file
+            include = path.join(path.dirname(gres_conf), words[1])
+            if include not in sources:
+                gres_lines += read_gres_conf(include, sources)
+                # missing for now, the index is stale once it shows up
+                sources.setdefault(include, None)
+        else:
+            gres_lines.append(line)
+    return gres_lines
 
 
-def split_node_name(node_name):
-    node_match = node_regex.match(node_name)
-    groups = node_match.groups()
-    # if node name is like gpu02 or bigmem05
-    if groups[-1] == '':
-        chassis = groups[0]
-        node_num = int(groups[1])
-    # if node name is like c13n05
-    else:
-        chassis = groups[0]+groups[1]
-        node_num = int(groups[2])
-    return chassis, node_num
+def _sources_unchanged(sources):
+    for file_path, mtime_size in sources.items():
+        if mtime_size is None:
+            if path.lexists(file_path):
+                return False
+            continue
+        try:
+            file_stat = stat(file_path)
+        except OSError:
+            return False
+        if mtime_size != [file_stat.st_mtime, file_stat.st_size]:
+            return False
+    return True
+
+
+# gres.conf path: gpu index, see get_gpu_index
+_gpu_indexes = {}
 
 
-def get_gpus():
+def get_gpu_index(gres_conf):
+    """
+    (node, gpu type) pairs from gres_conf and its includes, or None if there's no
+    gres_conf. Kept in memory and in the cache dir, and only re-read when one of
+    the files changes.
+    """
+    key = ['gres-index', gres_conf]
+    index = _gpu_indexes.get(gres_conf) or slurm_io.load_cached_json(key)
+    replaying = slurm_io.capture_settings['replay'] is not None
+    if index is not None and not replaying and _sources_unchanged(index['sources']):
+        _gpu_indexes[gres_conf] = index
+        return index['gpus']
+
+    sources = {}
+    gpus = []
+    gpu_pattern = re.compile(gpu_regex)
+    for line in read_gres_conf(gres_conf, sources):
+        gpu_match = gpu_pattern.match(line)
+        if gpu_match is not None:
+            groups = gpu_match.groups()
+            if groups is not None and groups[0] is not None and groups[1] is not None:
+                nodes, gpu = groups
+                gpus += [[node, gpu] for node in hostlist.expand_hostlist(nodes)]
+    if len(sources) == 0:
+        return None
+    index = {'sources': sources, 'gpus': gpus}
+    if not replaying:
+        _gpu_indexes[gres_conf] = index
+        slurm_io.store_cached_json(key, index)
+    return gpus
+
+
+def get_gpus(timeout=None):
     # where to look for gres conf
-    slurm_prefix = get_slurm_dir()
-    gres_conf = path.join(slurm_prefix, 'gres.conf')
-    if not( path.isfile(gres_conf) and access(gres_conf, R_OK)):
+    slurm_prefix = get_slurm_dir(timeout)
+    gpu_index = None
+    if slurm_prefix is not None:
+        gpu_index = get_gpu_index(path.join(slurm_prefix, 'gres.conf'))
+    if gpu_index is None:
         yield None
     else:
-        with open(gres_conf, 'r') as gres:
-            for line in gres:
-                gpu_match = gpu_regex.match(line)
-                if gpu_match is not None:
-                    groups = gpu_match.groups()
-                    if groups is not None and groups[0] is not None and groups[1] is not None:
-                        hostlist, gpu = groups
-                        for node in expand_node_list(hostlist):
-                            yield (node, gpu)
-
-
-def show_general_info():
-    partitions = ', '.join(sorted(set(get_subprocess_lines(sinfo_parts_cmd))))
-    gpu_info = get_gpus()
-    if gpu_info is None:
+        for node, gpu in gpu_index:
+            yield (node, gpu)
+
+
+def get_gres_gpu_types(gres):
+    # gpu:k80:4(S:0-1),mps:100 -> ['k80'], gpus without a type have none
+    return [parts[1] for parts in (g.split('(')[0].split(':') for g in gres.split(','))
+            if parts[0] == 'gpu' and len(parts) > 2]
+
+
+def show_general_info(cluster=None):
+    parts_cmd = slurm_io.get_cluster_cmd(sinfo_parts_cmd, cluster)
+    partitions = ', '.join(sorted(set(slurm_io.get_subprocess_lines(parts_cmd, cache=True))))
+    if cluster is None:
+        gpu_types = sorted(set(g[1] for g in get_gpus() if g is not None))
+    else:
+        gres_cmd = slurm_io.get_cluster_cmd(sinfo_gres_cmd, cluster)
+        gpu_types = sorted(set(gpu for gres in slurm_io.get_subprocess_lines(gres_cmd, cache=True)
+                               for gpu in get_gres_gpu_types(gres)))
+    if len(gpu_types) == 0:
         gpus = 'None'
     else:
-        gpus = ', '.join(set([a[1] for a in gpu_info]))
+        gpus = ', '.join(gpu_types)
     feature_set = set()
-    for feat_line in get_subprocess_lines(sinfo_feats_cmd):
+    feats_cmd = slurm_io.get_cluster_cmd(sinfo_feats_cmd, cluster)
+    for feat_line in slurm_io.get_subprocess_lines(feats_cmd, cache=True):
         [feature_set.add(x) for x in feat_line.split(',')]
     features = ', '.join(sorted(feature_set))
+    if cluster is not None:
+        print('{}:'.format(cluster))
     print("""Refer to https://research.computing.yale.edu/support/hpc/clusters
 and this cluster's page for more info
 
@@ -348,28 +662,114 @@ Features found:
 """.format(partitions, gpus, features))
 
 
-def add_job_info(node_info, job_glyphs, show_usage):
-    job_map = {}
-    for i, line in enumerate(get_subprocess_lines(sacct_cmd)):
-        if i == 0:
-            header = re.split(slurm_delim, line)
+# every distinct value we've stored, see intern_value
+_interned = {}
+
+
+def intern_value(value):
+    """
+    Return the copy of value we already store, if any, so a user, account,
+    partition, node name or set of features repeated across thousands of nodes
+    and jobs is only held once.
+    """
+    return _interned.setdefault(value, value)
+
+
+class Node(object):
+    """
+    One node's glyph, state, usage (cpu and/or ram, as shown), partitions,
+    features, gpu types (interned frozensets, so alike nodes share them) and
+    the jobs running on it.
+    """
+    __slots__ = ('glyph', 'state', 'usage', 'partition', 'feature', 'gpu_type', 'jobs')
+
+    def __init__(self, glyph):
+        self.glyph = glyph
+        self.state = None
+        self.usage = ()
+        self.partition = self.feature = self.gpu_type = intern_value(frozenset())
+        self.jobs = ()
+
+    def add(self, kind, values):
+        setattr(self, kind, intern_value(getattr(self, kind).union(values)))
+
+
+class Job(object):
+    """
+    One running job. Nodes refer to the Job itself, so its fields are stored once
+    however many nodes it runs on. array_id is the parent id of array tasks.
+    """
+    __slots__ = ('job_id', 'array_id', 'job_name', 'user', 'account', 'job_partition', 'nodes', 'glyph')
+
+    def __init__(self, fields, nodes, glyph):
+        # fields are job_fields, those left out of the sacct query blank
+        self.job_id, self.job_name, user, account, job_partition = fields
+        self.array_id = self.job_id.split('_')[0] if '_' in self.job_id else None
+        self.user = intern_value(user)
+        self.account = intern_value(account)
+        self.job_partition = intern_value(job_partition)
+        self.nodes = nodes
+        self.glyph = glyph
+
+
+def new_job_tracker():
+    """
+    Jobs from the last sacct poll, kept between polls (see --watch) so that only
+    jobs that started, ended or changed since then are expanded and re-glyphed.
+    """
+    return {'jobs': {},                  # sacct line: Job
+            'node_jobs': dd(list)}       # node: Jobs on it, in sacct order
+
+
+@slurm_io.timed
+def update_job_tracker(job_tracker, sacct_lines, job_glyphs):
+    new_lines = []
+    seen = set()
+    header, sacct_lines = slurm_io.read_header(sacct_lines)
+    for line in sacct_lines:
+        if line in job_tracker['jobs']:
+            seen.add(line)
+        elif line != '':
+            new_lines.append(line)
+
+    dirty = set()
+    # glyphs of jobs whose line changed, to hand on to their new line
+    glyphs = {}
+    for line in [l for l in job_tracker['jobs'] if l not in seen]:
+        job = job_tracker['jobs'].pop(line)
+        glyphs[job.job_id] = job.glyph
+        for node in job.nodes:
+            job_tracker['node_jobs'][node].remove(job)
+            dirty.add(node)
+    intern_node = _interned.setdefault
+    select_job = slurm_io.select_columns(header, job_fields, '')
+    select_nodes = slurm_io.select_columns(header, ['NodeList'])
+    for line, row in zip(new_lines, slurm_io.split_rows(new_lines)):
+        fields = select_job(row)
+        # job_glyphs is None when jobs aren't drawn, they don't need one
+        if fields[0] in glyphs or job_glyphs is None:
+            glyph = glyphs.get(fields[0])
         else:
-            sacct = dict(zip(header, re.split(slurm_delim, line)))
-            for node in expand_node_list(sacct['NodeList']):
-                job_id = sacct['JobID']
-                if '_' in job_id:
-                    job_ids = [job_id, job_id.split('_')[0]]
-                else:
-                    job_ids = [job_id]
-                for jid in job_ids:
-                    node_info[node]['job_info'][jid]['job_name'] = sacct['JobName']
-                    node_info[node]['job_info'][jid]['user'] = sacct['User']
-                    node_info[node]['job_info'][jid]['account'] = sacct['Account']
-                    node_info[node]['job_info'][jid]['job_partition'] = sacct['Partition']
-                if show_usage == 'job':
-                    if job_id not in job_map:
-                        job_map[job_id] = next(job_glyphs)
-                    node_info[node]['glyph'] = job_map[job_id]
+            glyph = next(job_glyphs)
+        node_list, = select_nodes(row)
+        job = Job(fields, tuple([intern_node(n, n) for n in hostlist.expand_hostlist(node_list)]), glyph)
+        job_tracker['jobs'][line] = job
+        for node in job.nodes:
+            job_tracker['node_jobs'][node].append(job)
+            dirty.add(node)
+    for node in dirty:
+        if len(job_tracker['node_jobs'][node]) == 0:
+            del job_tracker['node_jobs'][node]
+    slurm_io.add_timing('update_job_tracker', rows=len(new_lines), jobs=len(job_tracker['jobs']))
+
+
+@slurm_io.timed
+def add_job_info(node_info, job_tracker, show_usage):
+    for node, jobs in job_tracker['node_jobs'].items():
+        node_info[node].jobs = jobs
+        if show_usage == 'job':
+            node_info[node].glyph = jobs[-1].glyph
+    slurm_io.add_timing('add_job_info', nodes=len(job_tracker['node_jobs']), jobs=len(job_tracker['jobs']))
 
 
 def get_mem_usage(free_mem, total_mem):
@@ -384,134 +784,722 @@ def get_cpu_usage(aiot):
     return in_use / cores
 
 
-def add_node_info(node_info, chassis_layout, state_glyphs, usage_glyphs, show_usage):
-    for i, line in enumerate(get_subprocess_lines(sinfo_cmd)):
-        if i == 0:
-            header = re.split(slurm_delim, line)
-        else:
-            sinfo = dict(zip(header, re.split(slurm_delim, line)))
-            chassis, node_num = split_node_name(sinfo['HOSTNAMES'])
-            node_name = sinfo['HOSTNAMES']
-            cpu_usage = get_cpu_usage(sinfo['CPUS(A/I/O/T)'])
-            mem_usage = get_mem_usage(sinfo['FREE_MEM'], sinfo['MEMORY'])
-            if show_usage == 'cpu':
-                node_info[node_name]['glyph'] = get_node_glyph(sinfo['STATE'], cpu_usage,
-                                                               state_glyphs, usage_glyphs)
-            elif show_usage == 'ram':
-                node_info[node_name]['glyph'] = get_node_glyph(sinfo['STATE'], mem_usage,
-                                                               state_glyphs, usage_glyphs)
-            elif show_usage == 'both':
-                node_info[node_name]['glyph'] = (get_node_glyph(sinfo['STATE'], cpu_usage,
-                                                                state_glyphs, usage_glyphs) +
-                                                 get_node_glyph(sinfo['STATE'], mem_usage,
-                                                                state_glyphs, usage_glyphs))
-
-            if chassis_layout[chassis] < node_num:
-                chassis_layout[chassis] = node_num
-            node_info[node_name]['partition'].add(sinfo['PARTITION'])
-            [node_info[node_name]['feature'].add(f) for f in sinfo['AVAIL_FEATURES'].split(',')]
-
-
-def add_gpu_info(node_info):
-    gpu_info = get_gpus()
-    if gpu_info is None:
-        pass
+@slurm_io.timed
+def add_node_info(node_info, sinfo_lines, chassis_layout, state_glyphs, usage_glyphs, show_usage):
+    # nodes, their states and usage, to glyph all at once
+    state_nodes, states, cpu_usage, mem_usage = [], [], [], []
+    header, rows = slurm_io.read_rows(sinfo_lines)
+    # only the columns plan_queries asked for are there, the rest are None
+    select = slurm_io.select_columns(header, ['HOSTNAMES', 'STATE', 'CPUS(A/I/O/T)', 'FREE_MEM', 'MEMORY',
+                                              'PARTITION', 'AVAIL_FEATURES', 'GRES'])
+    n_rows = 0
+    for (node_name, state, aiot, free_mem, memory, partition, features, gres) in map(select, rows):
+        n_rows += 1
+        chassis, node_num = split_node_name(node_name)
+        node_name = intern_value(node_name)
+        if state is not None:
+            state_nodes.append(node_name)
+            states.append(state)
+        if aiot is not None:
+            cpu_usage.append(get_cpu_usage(aiot))
+        if free_mem is not None:
+            mem_usage.append(get_mem_usage(free_mem, memory))
+
+        chassis_layout[chassis][node_num] = node_name
+        if partition is not None:
+            node_info[node_name].add('partition', [partition])
+        if features is not None:
+            node_info[node_name].add('feature', features.split(','))
+        if gres is not None:
+            node_info[node_name].add('gpu_type', get_gres_gpu_types(gres))
+
+    set_node_states(node_info, state_nodes, states, cpu_usage, mem_usage, state_glyphs, usage_glyphs, show_usage)
+    slurm_io.add_timing('add_node_info', rows=n_rows, nodes=len(node_info))
+    # what --history records
+    return state_nodes, states, cpu_usage or None, mem_usage or None
+
+
+def set_node_states(node_info, state_nodes, states, cpu_usage, mem_usage, state_glyphs, usage_glyphs, show_usage):
+    # give nodes their states, the usage --show shows and, unless there's nothing to draw, their glyphs
+    if state_glyphs is None:
+        # exporting, nothing to draw
+        glyphs = None
+    elif show_usage == 'cpu':
+        glyphs = get_node_glyphs(states, cpu_usage, state_glyphs, usage_glyphs)
+    elif show_usage == 'ram':
+        glyphs = get_node_glyphs(states, mem_usage, state_glyphs, usage_glyphs)
+    elif show_usage == 'both':
+        glyphs = [cpu + mem for cpu, mem in zip(get_node_glyphs(states, cpu_usage, state_glyphs, usage_glyphs),
+                                                get_node_glyphs(states, mem_usage, state_glyphs, usage_glyphs))]
     else:
-        for (nodelist, gpu) in gpu_info:
-            for node in expand_node_list(nodelist):
-                node_info[node]['gpu_type'].add(gpu)
-
-
-def get_cluster_info(state_glyphs, usage_glyphs, job_glyphs, show_usage):
-    chassis_layout = dd(lambda: 1)
-    node_info = dd(lambda: {'glyph': state_glyphs['not a node'], 'partition': set(),
-                            'feature': set(), 'gpu_type': set(),
-                            'job_info': dd(lambda: {'job_name': '',
-                                                    'user': '',
-                                                    'account': '',
-                                                    'job_partition': ''}),
-                            })
-
-    add_job_info(node_info, job_glyphs, show_usage)
-    add_node_info(node_info, chassis_layout, state_glyphs, usage_glyphs, show_usage)
-    add_gpu_info(node_info)
-    return(node_info, chassis_layout)
+        glyphs = None
+    metrics = {'cpu': [cpu_usage], 'ram': [mem_usage], 'both': [cpu_usage, mem_usage], 'job': []}[show_usage]
+    for i, node_name in enumerate(state_nodes):
+        node = node_info[node_name]
+        node.state = intern_value(states[i])
+        node.usage = tuple(usage[i] for usage in metrics)
+        if glyphs is not None:
+            node.glyph = glyphs[i]
+
+
+@slurm_io.timed
+def add_gpu_info(node_info, gpu_info):
+    for (node, gpu) in gpu_info:
+        node_info[node].add('gpu_type', [gpu])
+    slurm_io.add_timing('add_gpu_info', rows=len(gpu_info))
+
+
+def _collect(collector, results, name):
+    try:
+        results[name] = (collector(), None)
+    except (Exception, SystemExit) as e:
+        results[name] = (None, e)
 
 
-def _filter(bool_list):
-    if len(bool_list) ==0:
-        return False
+def collect_concurrently(collectors):
+    """
+    Run each collector in its own thread so their slurm commands overlap.
+    Returns a dict of name: (result, error) with exactly one of the pair set.
+    """
+    results = {}
+    threads = []
+    for name, collector in collectors.items():
+        thread = threading.Thread(target=_collect, args=(collector, results, name))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _collection_warning(what, error):
+    print('Warning: skipping {} ({})'.format(what, error), file=sys.stderr)
+
+
+def get_cluster_info(state_glyphs, usage_glyphs, job_glyphs, show_usage, plan, timeout=slurm_timeout,
+                     job_tracker=None):
+    # chassis: {node number: node name}, only for nodes that exist
+    chassis_layout = dd(dict)
+    node_info = dd(lambda: Node(state_glyphs['not a node'] if state_glyphs is not None else None))
+
+    collectors = {'sinfo': lambda: list(slurm_io.get_subprocess_lines(plan['sinfo'], timeout, cache=True))}
+    if plan['sacct'] is not None:
+        collectors['sacct'] = lambda: list(slurm_io.get_subprocess_lines(plan['sacct'], timeout, cache=True))
+    if plan['gres']:
+        collectors['gres'] = lambda: [g for g in get_gpus(timeout) if g is not None]
+    collected = collect_concurrently(collectors)
+
+    # node info is the only thing we can't do without
+    sinfo_lines, error = collected['sinfo']
+    if error is not None:
+        if isinstance(error, SystemExit):
+            raise error
+        sys.exit('Couldn\'t get node info: {}'.format(error))
+    if job_tracker is None:
+        job_tracker = new_job_tracker()
+    sacct_lines, error = collected.get('sacct', ([], None))
+    if error is not None:
+        # keep whatever jobs we saw last time
+        _collection_warning('job info', error)
     else:
-        return(all(bool_list))
+        update_job_tracker(job_tracker, sacct_lines, job_glyphs if show_usage == 'job' else None)
+    gpu_info, error = collected.get('gres', ([], None))
+    if error is not None:
+        _collection_warning('gpu info', error)
+        gpu_info = []
+
+    add_job_info(node_info, job_tracker, show_usage)
+    frame = add_node_info(node_info, sinfo_lines, chassis_layout, state_glyphs, usage_glyphs, show_usage)
+    add_gpu_info(node_info, gpu_info)
+    if plan.get('history') is not None:
+        record_history(plan['history'], frame)
+    return(node_info, chassis_layout)
+
+
+@slurm_io.timed
+def record_history(history_path, frame):
+    import node_history
+    try:
+        node_history.append_frame(history_path, *frame)
+    except (IOError, OSError, ValueError) as e:
+        _collection_warning('history', e)
+    slurm_io.add_timing('record_history', nodes=len(frame[0]))
+
+
+def get_history_info(history, frame_num, state_glyphs, usage_glyphs, show_usage):
+    """
+    Frame frame_num of a NodeHistory as get_cluster_info returns it, and its time.
+    """
+    when, nodes, states, cpu_usage, mem_usage = history.read(frame_num)
+    chassis_layout = dd(dict)
+    node_info = dd(lambda: Node(state_glyphs['not a node']))
+    for node_name in nodes:
+        chassis, node_num = split_node_name(node_name)
+        chassis_layout[chassis][node_num] = intern_value(node_name)
+    set_node_states(node_info, nodes, states, [u or 0.0 for u in cpu_usage], [u or 0.0 for u in mem_usage],
+                    state_glyphs, usage_glyphs, show_usage)
+    return when, (node_info, chassis_layout)
+
+
+def get_clusters_info(clusters, state_glyphs, usage_glyphs, job_glyphs, show_usage, plans, timeout, job_trackers):
+    """
+    get_cluster_info for every cluster at once, so the slowest one, not all of them
+    together, sets how long it takes. Each slurm command still times out on its own.
+    Returns a dict of cluster: ((node_info, chassis_layout), error).
+    """
+    def collector(cluster):
+        return lambda: get_cluster_info(state_glyphs, usage_glyphs, job_glyphs, show_usage, plans[cluster],
+                                        timeout, job_trackers[cluster])
+    return collect_concurrently(dict((cluster, collector(cluster)) for cluster in clusters))
+
+
+def build_filter_index(node_info, kinds):
+    """
+    Map every value of the given node attributes or job fields to the set of
+    nodes that have it, in one pass over node_info.
+    """
+    index = dict((kind, dd(set)) for kind in kinds)
+    for node, info in node_info.items():
+        for kind in kinds:
+            if kind in node_filters:
+                values = getattr(info, kind)
+            elif kind == 'job_id':
+                values = [job.job_id for job in info.jobs] + [job.array_id for job in info.jobs if job.array_id]
+            else:
+                values = [getattr(job, kind) for job in info.jobs]
+            for value in values:
+                index[kind][value].add(node)
+    return index
+
 
+def _last_job(node, job_id):
+    for job in reversed(node.jobs):
+        if job_id == job.job_id or job_id == job.array_id:
+            return job
 
-## work here
-def filter_node(node, filters, nodename):
-    bools = []
-    for node_filter in ['partition', 'feature', 'gpu_type']:
-        if node_filter in filters:
-            for filt in filters[node_filter]:
-                bools.append(filt in node[node_filter])
+
+def get_highlighted_nodes(node_info, filters):
+    """
+    Nodes that match every filter given. Node filters match whole values, job
+    filters match substrings, and with job ids the job filters apply to those jobs.
+    """
+    if 'job_id' in filters:
+        kinds = [k for k in node_filters if k in filters] + ['job_id']
+    else:
+        kinds = [k for k in node_filters + job_filters if k in filters]
+    if len(kinds) == 0:
+        return set()
+    index = build_filter_index(node_info, kinds)
+
+    matches = []
+    for kind in node_filters:
+        for filt in filters.get(kind, []):
+            matches.append(index[kind].get(filt, set()))
     if 'job_id' in filters:
         for job_id in filters['job_id']:
-            bools.append(job_id in node['job_info'])
-    
-            for job_filter in ['job_partition', 'user', 'account']:
-                if job_filter in filters:
-                    for filt in filters[job_filter]:
-                        bools.append(filt in node['job_info'][job_id][job_filter])
+            nodes = index['job_id'].get(job_id, set())
+            for kind in job_filters:
+                for filt in filters.get(kind, []):
+                    nodes = set(n for n in nodes if filt in getattr(_last_job(node_info[n], job_id), kind))
+            matches.append(nodes)
     else:
-        for job_filter in ['job_partition', 'user', 'account']:
-            if job_filter in filters:
-                for filt in filters[job_filter]:
-                    bools.append(any([filt in node['job_info'][job][job_filter] for job in node['job_info']]))
-
-    return(_filter(bools))
+        for kind in job_filters:
+            for filt in filters.get(kind, []):
+                # there are far fewer users/accounts/partitions than nodes, so test each value once
+                matches.append(set().union(*[nodes for value, nodes in index[kind].items() if filt in value]))
+    return set.intersection(*sorted(matches, key=len))
 
 
 def highlight_node(text, color):
     return u'\u001b[{}m{}\u001b[0m'.format(color, text)
 
 
-def print_node_layout(node_info, chassis, filters, state_glyphs, show_usage, highlight_color):
+def render_node_layout(node_info, chassis, filters, state_glyphs, show_usage, highlight_color):
+    """
+    One row per chassis, with a cell for every node number up to the highest one
+    in it. Numbers without a node are left blank.
+    """
+    rows = []
+    highlighted = set()
+    if len(filters) > 0:
+        highlighted = get_highlighted_nodes(node_info, filters)
+    if len(chassis) == 0:
+        return rows
+    empty = state_glyphs['not a node'] * (2 if show_usage == 'both' else 1)
     chas_pad = get_pad(chassis.keys())
     for chas in sorted(chassis.keys()):
-        print((chas + ': ').ljust(chas_pad), end='')
+        nodes = chassis[chas]
         line = []
-        for n in range(1, chassis[chas] + 1):
-            if chas.startswith('c'):
-                node = '{}n{:02d}'.format(chas, n)
+        last = min(min(nodes), 1) - 1
+        for num in sorted(nodes):
+            line += [empty] * (num - last - 1)
+            last = num
+            node = nodes[num]
+            glyph = node_info[node].glyph if node in node_info else empty
+            if glyph == state_glyphs['not a node']:
+                glyph = empty
+            if node in highlighted:
+                line.append(highlight_node(glyph, colors[highlight_color]))
             else:
-                node = '{}{:02d}'.format(chas, n)
-            if show_usage == 'both' and node_info[node]['glyph'] == state_glyphs['not a node']:
-                node_info[node]['glyph'] += state_glyphs['not a node']
-            highlight = False
-            if len(filters) > 0:
-                highlight = filter_node(node_info[node], filters, node)
-            if highlight:
-                line.append(highlight_node(node_info[node]['glyph'], colors[highlight_color]))
+                line.append(glyph)
+        rows.append((chas + ': ').ljust(chas_pad) + u'|{}|'.format(u'|'.join(line)))
+    return rows
+
+
+def zoom_layout(node_info, chassis, only_chassis, only_partitions):
+    """
+    The part of the layout in the given chassis and partitions, either of which
+    can be empty for all of them.
+    """
+    zoomed = dd(dict)
+    for chas, nodes in chassis.items():
+        if len(only_chassis) > 0 and chas not in only_chassis:
+            continue
+        for num, node in nodes.items():
+            if len(only_partitions) == 0 or not node_info[node].partition.isdisjoint(only_partitions):
+                zoomed[chas][num] = node
+    return zoomed
+
+
+def get_screen_size():
+    # columns and lines of the terminal
+    if get_terminal_size is not None:
+        return tuple(get_terminal_size())
+    return int(environ.get('COLUMNS', 80)), int(environ.get('LINES', 24))
+
+
+def get_screen_rows():
+    return get_screen_size()[1]
+
+
+def get_display_width(row):
+    # columns row takes up on screen: colors take none, wide (emoji, cjk) characters two
+    row = ansi_regex.sub(u'', row)
+    if all(ord(c) < 0x1100 for c in row):
+        return len(row)
+    return sum(2 if unicodedata.east_asian_width(c) in 'WF' else 0 if unicodedata.combining(c) else 1
+               for c in row)
+
+
+def _usage_cell(usage, usage_glyphs):
+    thresholds = list(usage_glyphs.keys())
+    return u'{} {:3.0f}%'.format(usage_glyphs[thresholds[quantize_usage([usage], thresholds)[0]]], usage * 100)
+
+
+def render_overview(node_info, chassis, filters, usage_glyphs, show_usage, highlight_color, max_rows):
+    """
+    The layout summarized into at most max_rows lines, each for a run of
+    whole chassis: how many nodes, their mean and max usage, how many are idle
+    and down, and how many match the filters.
+    """
+    highlighted = set()
+    if len(filters) > 0:
+        highlighted = get_highlighted_nodes(node_info, filters)
+    metrics = {'cpu': ['cpu'], 'ram': ['ram'], 'both': ['cpu', 'ram'], 'job': []}[show_usage]
+    header = ['chassis', 'nodes']
+    for metric in metrics:
+        header += [metric + ' mean', 'max']
+    header += ['idle', 'down'] + (['jobs'] if show_usage == 'job' else []) + ['match']
+
+    names = sorted(chassis.keys())
+    per_bin = max(1, -(-len(names) // max(1, max_rows - 1)))
+    table = [header]
+    matched = []
+    for start in range(0, len(names), per_bin):
+        in_bin = names[start:start + per_bin]
+        nodes = [node_info[n] for chas in in_bin for n in chassis[chas].values() if n in node_info]
+        label = in_bin[0] if len(in_bin) == 1 else u'{}-{}'.format(in_bin[0], in_bin[-1])
+        row = [label, str(len(nodes))]
+        for i in range(len(metrics)):
+            usage = [node.usage[i] for node in nodes if len(node.usage) > i]
+            if len(usage) == 0:
+                row += ['', '']
             else:
-                line.append(node_info[node]['glyph'])
-        print(u'|{}|'.format(u'|'.join(line)))
+                row += [_usage_cell(sum(usage) / len(usage), usage_glyphs), _usage_cell(max(usage), usage_glyphs)]
+        kinds = [get_state_kind(node.state) for node in nodes if node.state is not None]
+        row += [str(kinds.count('idle')), str(kinds.count('down'))]
+        if show_usage == 'job':
+            row.append(str(len(set(job.job_id for node in nodes for job in node.jobs))))
+        match = sum(1 for chas in in_bin for n in chassis[chas].values() if n in highlighted)
+        row.append(str(match) if len(filters) > 0 else '')
+        matched.append(match > 0)
+        table.append(row)
+
+    widths = [max(len(row[i]) for row in table) for i in range(len(header))]
+    rows = []
+    for row, match in zip(table, [False] + matched):
+        cells = [row[0].ljust(widths[0])] + [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]
+        if match:
+            cells[0] = highlight_node(cells[0], colors[highlight_color])
+        rows.append(u'  '.join(cells))
+    return rows
+
+
+def render_layout(args, node_info, chassis, filters, state_glyphs, usage_glyphs, max_rows=None):
+    if args['chassis'] is not None or args['only_partition'] is not None:
+        chassis = zoom_layout(node_info, chassis, set(','.join(args['chassis'] or []).split(',')) - set(['']),
+                              set(','.join(args['only_partition'] or []).split(',')) - set(['']))
+    if args['zoom_out']:
+        return render_overview(node_info, chassis, filters, usage_glyphs, args['show'], args['color'],
+                               max_rows if max_rows is not None else get_screen_rows() - 1)
+    return render_node_layout(node_info, chassis, filters, state_glyphs, args['show'], args['color'])
+
+
+def render_clusters(args, clusters, collected, filters, state_glyphs, usage_glyphs):
+    """
+    Each cluster's layout under its name, or why it's missing. Zoomed out, the
+    clusters share the screen.
+    """
+    rows = []
+    max_rows = max(1, (get_screen_rows() - 1) // len(clusters) - 2)
+    for cluster in clusters:
+        cluster_info, error = collected[cluster]
+        rows.append(u'{}:'.format(cluster))
+        if error is not None:
+            rows.append(u'  unavailable ({})'.format(error))
+        else:
+            node_info, chassis = cluster_info
+            rows += render_layout(args, node_info, chassis, filters, state_glyphs, usage_glyphs, max_rows)
+        rows.append(u'')
+    return rows
+
+
+@slurm_io.timed
+def print_node_layout(args, node_info, chassis, filters, state_glyphs, usage_glyphs):
+    rows = render_layout(args, node_info, chassis, filters, state_glyphs, usage_glyphs)
+    for row in rows:
+        print(row)
+    slurm_io.add_timing('print_node_layout', rows=len(rows), nodes=len(node_info))
+
+
+def new_screen(header_rows):
+    """
+    What redraw_node_layout last drew under header_rows, and on what size of terminal.
+    """
+    return {'header': header_rows, 'rows': None, 'size': None, 'fit': False}
+
+
+def redraw_node_layout(screen, rows):
+    """
+    Repaint the rows that differ from the last ones drawn on screen, each at its
+    line on the terminal. Unless the header and layout fit the terminal, in lines
+    and columns, and it hasn't changed size, everything is repainted from the top,
+    as is a layout that changed shape.
+    """
+    # move to line;column, home and clear the screen, clear to the end of the line
+    move, clear_screen, clear_line = u'\u001b[{};1H', u'\u001b[H\u001b[J', u'\u001b[K'
+    size = get_screen_size()
+    header = screen['header']
+    # a line left over below the layout for the cursor, so nothing scrolls
+    fit = len(header) + len(rows) < size[1] and all(get_display_width(r) <= size[0] for r in header + rows)
+    old_rows = screen['rows']
+    if not fit or not screen['fit'] or size != screen['size'] or old_rows is None or len(old_rows) != len(rows):
+        out = [clear_screen] + [row + u'\n' for row in header + rows]
+    else:
+        out = [move.format(len(header) + i + 1) + row + clear_line
+               for i, (old_row, row) in enumerate(zip(old_rows, rows)) if row != old_row]
+        if len(out) > 0:
+            # leave the cursor below the layout
+            out.append(move.format(len(header) + len(rows) + 1))
+    screen.update(rows=rows, size=size, fit=fit)
+    sys.stdout.write(u''.join(out))
+    sys.stdout.flush()
+
+
+class _RowsWriter(object):
+    # collects what's printed to it, see get_header_rows
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text.decode('utf-8') if isinstance(text, bytes) else text)
+
+    def flush(self):
+        pass
+
+
+def get_header_rows(args, state_glyphs, usage_glyphs):
+    # what print_header prints, as rows redraw_node_layout can repaint with the layout
+    stdout, sys.stdout = sys.stdout, _RowsWriter()
+    try:
+        print_header(args, state_glyphs, usage_glyphs)
+    finally:
+        header, sys.stdout = sys.stdout, stdout
+    return u''.join(header.parts).splitlines()
+
+
+def print_header(args, state_glyphs, usage_glyphs):
+    if args['general_info']:
+        for cluster in slurm_io.get_clusters(args['clusters']):
+            try:
+                show_general_info(cluster)
+            except RuntimeError as e:
+                _collection_warning('general info' + (' for ' + cluster if cluster is not None else ''), e)
+    if args['legend']:
+        print_legend(args['show'], state_glyphs, usage_glyphs)
+
+
+def plan_export(cluster=None):
+    # everything node_fields has: state, both usages, partitions, features, gpu types and jobs
+    return plan_queries('both', dict((f, []) for f in ['partition', 'feature', 'gpu_type', 'job_id']), ['STATE'],
+                        cluster)
+
+
+def get_node_records(node_info, cluster=None):
+    """
+    node_fields for each node sinfo listed, in name order.
+    """
+    for node_name in sorted(node_info):
+        node = node_info[node_name]
+        if node.state is None:
+            continue
+        cpu_usage, mem_usage = node.usage
+        yield od([('cluster', cluster), ('node', node_name), ('state', node.state),
+                  ('cpu_usage', round(cpu_usage, 4)), ('mem_usage', round(mem_usage, 4)),
+                  ('partitions', sorted(node.partition)), ('features', sorted(node.feature)),
+                  ('gpu_types', sorted(node.gpu_type)), ('jobs', [job.job_id for job in node.jobs])])
+
+
+@slurm_io.timed
+def collect_node_records(clusters, plans, timeout):
+    """
+    Node records from every cluster, without any glyphs. A cluster we can't get
+    is skipped with a warning, unless it's the only one.
+    """
+    collected = get_clusters_info(clusters, None, None, repeat(None), 'both', plans, timeout,
+                                  dict((c, None) for c in clusters))
+    records = []
+    for cluster in clusters:
+        cluster_info, error = collected[cluster]
+        if error is None:
+            records += get_node_records(cluster_info[0], cluster)
+        elif clusters == [None]:
+            raise error if isinstance(error, SystemExit) else SystemExit(str(error))
+        else:
+            _collection_warning('cluster {}'.format(cluster), error)
+    slurm_io.add_timing('collect_node_records', nodes=len(records))
+    return records
+
+
+def format_node_records(records, output_format):
+    if output_format == 'ndjson':
+        return slurm_io.format_ndjson(records)
+    if output_format == 'csv':
+        return slurm_io.format_csv(records, node_fields)
+    # only cluster and node label the usage gauges, so a node's series survive it changing state
+    records = list(records)
+    return chain(slurm_io.format_prometheus((dict(r, jobs=len(r['jobs'])) for r in records), 'orwell_node',
+                                            node_metric_labels, node_metrics),
+                 slurm_io.format_prometheus_info(records, 'orwell_node_state', 'The state the node is in.',
+                                                 node_metric_labels + ['state']),
+                 slurm_io.format_prometheus_info(records, 'orwell_node_info',
+                                                 "The node's partitions, features and gpu types.",
+                                                 node_metric_labels + node_info_labels))
+
+
+def export_cluster_info(args):
+    clusters = slurm_io.get_clusters(args['clusters'])
+    plans = get_plans(args, clusters, plan_export)
+    if args['watch']:
+        slurm_io.cap_cache_ttl(args['watch'])
+    try:
+        while True:
+            started = time.time()
+            for line in format_node_records(collect_node_records(clusters, plans, args['timeout']), args['output']):
+                print(line)
+            sys.stdout.flush()
+            if not args['watch']:
+                break
+            time.sleep(max(0, args['watch'] - (time.time() - started)))
+    except KeyboardInterrupt:
+        pass
+
+
+def serve_node_exporter(args):
+    clusters = slurm_io.get_clusters(args['clusters'])
+    plans = get_plans(args, clusters, plan_export)
+    slurm_io.cap_cache_ttl(args['exporter_interval'])
+
+    def collect():
+        records = collect_node_records(clusters, plans, args['timeout'])
+        return dict(('/metrics' if f == 'prometheus' else '/' + f, (f, u''.join(line + u'\n' for line in
+                                                                               format_node_records(records, f))))
+                    for f in slurm_io.output_formats)
+    slurm_io.serve_exporter(slurm_io.get_exporter_address(args['exporter']), collect, args['exporter_interval'])
+
+
+def get_plans(args, clusters, plan_cluster):
+    # plan_cluster(cluster) for each cluster, and where to record its --history
+    plans = {}
+    for cluster in clusters:
+        plans[cluster] = plan_cluster(cluster)
+        plans[cluster]['history'] = slurm_io.get_cluster_path(args['history'], cluster) \
+            if args['history'] is not None else None
+    return plans
+
+
+def get_extra_columns(args):
+    # sinfo columns the layout options need beyond what --show and the filters do
+    columns = []
+    if args['history'] is not None:
+        columns += ['STATE', 'CPUS(A/I/O/T)', 'FREE_MEM', 'MEMORY']
+    if args['zoom_out']:
+        columns.append('STATE')
+    if args['only_partition'] is not None:
+        columns.append('PARTITION')
+    return columns
 
 
 def show_cluster_info(args, filters):
     state_glyphs = gen_state_glyphs(args['glyphs'])
     usage_glyphs = gen_usage_glyphs(args['glyphs'])
     job_glyphs = gen_job_glyphs(args['glyphs'])
-    if args['general_info']:
-        show_general_info()
-    if args['legend']:
-        print_legend(args['show'], state_glyphs, usage_glyphs)
+    print_header(args, state_glyphs, usage_glyphs)
+    clusters = slurm_io.get_clusters(args['clusters'])
+    plans = get_plans(args, clusters, lambda c: plan_queries(args['show'], filters, get_extra_columns(args), c))
+
+    if clusters == [None]:
+        # get node/partition/job info
+        node_info, chassis_layout = get_cluster_info(state_glyphs, usage_glyphs, job_glyphs, args['show'],
+                                                     plans[None], args['timeout'])
+        # print node layout
+        print_node_layout(args, node_info, chassis_layout, filters, state_glyphs, usage_glyphs)
+    else:
+        collected = get_clusters_info(clusters, state_glyphs, usage_glyphs, job_glyphs, args['show'], plans,
+                                      args['timeout'], dict((c, None) for c in clusters))
+        for row in render_clusters(args, clusters, collected, filters, state_glyphs, usage_glyphs):
+            print(row)
+
 
-    # get node/partition/job info
-    node_info, chassis_layout = get_cluster_info(state_glyphs, usage_glyphs, job_glyphs, args['show'])
-    # print node layout
-    print_node_layout(node_info, chassis_layout, filters, state_glyphs, args['show'], args['color'])
+def watch_cluster_info(args, filters):
+    state_glyphs = gen_state_glyphs(args['glyphs'])
+    usage_glyphs = gen_usage_glyphs(args['glyphs'])
+    job_glyphs = gen_job_glyphs(args['glyphs'])
+    # only re-read jobs that changed, and keep jobs on the same glyph, from one refresh to the next
+    clusters = slurm_io.get_clusters(args['clusters'])
+    job_trackers = dict((c, new_job_tracker()) for c in clusters)
+    plans = get_plans(args, clusters, lambda c: plan_queries(args['show'], filters, get_extra_columns(args), c))
+    slurm_io.cap_cache_ttl(args['watch'])
+
+    # the header is only collected once, and repainted with the layout when it has to be
+    screen = new_screen(get_header_rows(args, state_glyphs, usage_glyphs))
+    try:
+        while True:
+            started = time.time()
+            if clusters == [None]:
+                node_info, chassis_layout = get_cluster_info(state_glyphs, usage_glyphs, job_glyphs, args['show'],
+                                                             plans[None], args['timeout'], job_trackers[None])
+                new_rows = render_layout(args, node_info, chassis_layout, filters, state_glyphs, usage_glyphs)
+            else:
+                collected = get_clusters_info(clusters, state_glyphs, usage_glyphs, job_glyphs, args['show'],
+                                              plans, args['timeout'], job_trackers)
+                new_rows = render_clusters(args, clusters, collected, filters, state_glyphs, usage_glyphs)
+            redraw_node_layout(screen, new_rows)
+            time.sleep(max(0, args['watch'] - (time.time() - started)))
+    except KeyboardInterrupt:
+        pass
+
+
+def open_histories(args, clusters):
+    # NodeHistory for each cluster, or why it can't be read
+    import node_history
+    histories = {}
+    for cluster in clusters:
+        try:
+            histories[cluster] = (node_history.NodeHistory(slurm_io.get_cluster_path(args['history'], cluster)), None)
+        except (IOError, OSError, ValueError) as e:
+            if clusters == [None]:
+                sys.exit('Couldn\'t read history: {}'.format(e))
+            histories[cluster] = (None, e)
+    return histories
+
+
+def render_history(args, clusters, histories, when, filters, state_glyphs, usage_glyphs):
+    """
+    The layout of each cluster as last recorded at or before when, under the
+    time it was recorded.
+    """
+    collected, times = {}, []
+    for cluster in clusters:
+        history, error = histories[cluster]
+        if error is not None:
+            collected[cluster] = (None, error)
+            continue
+        frame_time, collected[cluster] = get_history_info(history, history.find(when), state_glyphs, usage_glyphs,
+                                                          args['show'])
+        collected[cluster] = (collected[cluster], None)
+        times.append((cluster, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(frame_time))))
+    if clusters == [None]:
+        node_info, chassis_layout = collected[None][0]
+        return [u'as of {}'.format(times[0][1])] + render_layout(args, node_info, chassis_layout, filters,
+                                                                  state_glyphs, usage_glyphs)
+    return [u'as of ' + u', '.join(u'{} {}'.format(c, t) for c, t in times)] + \
+        render_clusters(args, clusters, collected, filters, state_glyphs, usage_glyphs)
+
+
+def replay_cluster_info(args, filters):
+    if args['history'] is None:
+        sys.exit('--at and --replay-range read --history FILE')
+    if args['show'] == 'job':
+        sys.exit('Jobs aren\'t kept in --history, --show cpu, ram or both')
+    state_glyphs = gen_state_glyphs(args['glyphs'])
+    usage_glyphs = gen_usage_glyphs(args['glyphs'])
+    clusters = slurm_io.get_clusters(args['clusters'])
+    histories = open_histories(args, clusters)
+    to_time = lambda t: time.mktime(slurm_io.parse_time(t).timetuple())
+    if args['at'] is not None:
+        if args['legend']:
+            print_legend(args['show'], state_glyphs, usage_glyphs)
+        for row in render_history(args, clusters, histories, to_time(args['at']), filters, state_glyphs,
+                                  usage_glyphs):
+            print(row)
+        return
+
+    start, _, end = args['replay_range'].partition(',')
+    start, end = to_time(start), to_time(end) if end != '' else float('inf')
+    # step through the frames of the first cluster we can read
+    history = [h for h, e in (histories[c] for c in clusters) if h is not None]
+    if len(history) == 0:
+        sys.exit('Couldn\'t read history for any cluster')
+    history = history[0]
+    legend = get_header_rows(dict(args, general_info=False), state_glyphs, usage_glyphs)
+    screen = new_screen(legend)
+    try:
+        for frame_num in range(history.find(start), len(history)):
+            frame_time = history.times[frame_num]
+            if frame_time > end:
+                break
+            new_rows = render_history(args, clusters, histories, frame_time, filters, state_glyphs, usage_glyphs)
+            redraw_node_layout(screen, new_rows)
+            time.sleep(args['watch'] or replay_delay)
+    except KeyboardInterrupt:
+        pass
 
 
 # Main
 if __name__ == '__main__':
     args = get_args()
+    slurm_io.configure_cache(args)
+    slurm_io.configure_capture(args)
+    slurm_io.configure_diagnostics(args)
+    if args['serve']:
+        # start with what a plain orwell-cli run asks for, other queries are added as clients ask
+        default_plan = plan_queries('cpu', {})
+        slurm_io.serve_collector(lambda cmd: list(slurm_io.get_subprocess_lines(cmd, args['timeout'])),
+                                 args['poll_interval'], [default_plan['sinfo'], slurm_conf_cmd])
+        sys.exit(0)
+    if args['exporter'] is not None:
+        serve_node_exporter(args)
+        sys.exit(0)
     filters = get_filters(args)
-    show_cluster_info(args, filters)
+    if args['node_pattern'] is not None:
+        add_node_patterns(args['node_pattern'])
+    if args['at'] is not None or args['replay_range'] is not None:
+        replay_cluster_info(args, filters)
+    elif args['output'] != 'grid':
+        export_cluster_info(args)
+    elif args['watch']:
+        watch_cluster_info(args, filters)
+    else:
+        show_cluster_info(args, filters)
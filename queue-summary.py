@@ -1,13 +1,38 @@
 #!/usr/bin/env python
+from __future__ import print_function
+import re
 import sys
+import time
+import heapq
 import argparse
-import subprocess
-from collections import defaultdict as dd
+from os import path, makedirs
+from itertools import chain
+from collections import Counter, OrderedDict as od, defaultdict as dd
+import slurm_io
 
 size_multipliers = {'M':1, 'G':1024, 'T':1024**2}
+mem_multipliers = dict(size_multipliers, K=1.0/1024)
+req_mem_regex = re.compile(r'^([\d.]+)([KMGT]?)([cn]?)$')
 core_node_keys = {'c':'ReqCPUS', 'n':'ReqNodes'}
 avail_sort = ['Jobs', 'Nodes', 'CPUs', 'GPUs', 'RAM']
 avail_levels = ['User', 'Account', 'State', 'Partition']
+# prometheus metrics for --output prometheus and --exporter
+summary_metrics = od([('jobs', 'Jobs.'), ('nodes', 'Nodes requested.'), ('cpus', 'CPUs requested.'),
+                      ('gpus', 'GPUs requested.'), ('ram_bytes', 'Memory requested, in bytes.')])
+sacct_fields = 'User,Account,State,Partition,ReqCPUS,ReqNodes,ReqMem,ReqGRES'
+# how sacct prints times
+time_format = '%Y-%m-%dT%H:%M:%S'
+# history queries: hours of history per sacct query, and how many queries to run at once
+slice_hours = 24
+parallel_queries = 4
+# how often --exporter summarizes the queue
+exporter_interval = 30
+# below this many jobs summing in plain python beats importing numpy
+numpy_min_jobs = 500000
+# per-day rollups of history, kept with the slurm_io snapshots unless --rollups says otherwise,
+# and how many days old a day has to be before its jobs are done changing and it's rolled up
+rollup_db = 'queue-summary-rollups.sqlite'
+rollup_after_days = 7
 
 def get_levels(level_string):
     levels = []
@@ -21,51 +46,366 @@ def get_levels(level_string):
             sys.exit("Level not recognized: {}".format(l))
     return levels
 
-def get_subprocess_lines(cmd):
-    try:
-        pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        for line in pipe.stdout:
-            yield line.decode().strip()
-        pipe.wait()
-    except OSError as e:
-        print("Couldn't find slurm commands on your path. Are you sure you're on a slurm cluster?")
-        sys.exit(1)
-
-def get_job_memory(job_info):
-    units = job_info['ReqMem'][-2]
-    core_node = job_info['ReqMem'][-1]
-    raw_memory = float(job_info['ReqMem'][:-2])
-    return int(raw_memory * size_multipliers[units] * int(job_info[core_node_keys[core_node]]))
-
-def summarize_jobs(summary_levels):
-    summary = dd(lambda: {'Jobs': 0, 'CPUs': 0, 'GPUs': 0,
-                          'RAM': 0, 'Nodes': 0})
-    sacct_cmd = ['sacct', '-XaPsR,PD,RQ', '-oUser,Account,State,Partition,ReqCPUS,ReqNodes,ReqMem,ReqGRES']
-    for i, line in enumerate(get_subprocess_lines(sacct_cmd)):
-        if i == 0:
-            header = line.split('|')
+def get_job_memory(req_mem):
+    """
+    ReqMem as megabytes and what they are per: 4000Mc is 4000 per ReqCPUS, 4Gn
+    4096 per ReqNodes. Newer sacct leaves off the c/n, that is per node.
+    """
+    match = req_mem_regex.match(req_mem)
+    if match is None:
+        return 0, 'ReqNodes'
+    amount, units, core_node = match.groups()
+    return float(amount) * mem_multipliers[units or 'M'], core_node_keys[core_node or 'n']
+
+def get_job_gpus(req_gres):
+    # gpu:2, gpu:k80:2, gres/gpu:2 or gres/gpu=2, maybe among other gres
+    gpus = 0
+    for gres in req_gres.replace('=', ':').split(','):
+        parts = gres.split('(')[0].split(':')
+        if parts[0] in ('gpu', 'gres/gpu'):
+            gpus += int(parts[-1]) if len(parts) > 1 and parts[-1].isdigit() else 1
+    return gpus
+
+def new_summary():
+    return dd(lambda: {'Jobs': 0, 'CPUs': 0, 'GPUs': 0,
+                       'RAM': 0, 'Nodes': 0})
+
+def map_distinct(func, column):
+    # func of each value, calling it once per distinct value
+    mapped = dict((value, func(value)) for value in set(column))
+    return [mapped[value] for value in column]
+
+def group_sums(keys, values):
+    """
+    Sum each list in values by keys, in one pass, or with numpy for large job sets.
+    Returns a dict of key: list of sums.
+    """
+    numpy = slurm_io.get_numpy() if len(keys) >= numpy_min_jobs else None
+    if numpy is not None:
+        index = {}
+        codes = numpy.fromiter((index.setdefault(k, len(index)) for k in keys), dtype=numpy.int64, count=len(keys))
+        sums = [numpy.bincount(codes, weights=numpy.asarray(v, dtype=numpy.float64), minlength=len(index)).tolist()
+                for v in values]
+        return dict((key, [int(round(s[code])) for s in sums]) for key, code in index.items())
+    grouped = {}
+    for key, jobs, cpus, ram, nodes, gpus in zip(keys, *values):
+        key_sums = grouped.get(key)
+        if key_sums is None:
+            grouped[key] = [jobs, cpus, ram, nodes, gpus]
         else:
-            job_info = dict(zip(header, line.split('|')))
-            job_info['State'] = job_info['State'].lower()
-            job_memory = get_job_memory(job_info)
-            level_idx = tuple(job_info[x] for x in summary_levels)
-            summary[level_idx]['Jobs'] += 1
-            summary[level_idx]['CPUs'] += int(job_info['ReqCPUS'])
-            summary[level_idx]['RAM'] += get_job_memory(job_info)
-            summary[level_idx]['Nodes'] += int(job_info['ReqNodes'])
-            if job_info['ReqGRES'].startswith('gpu'):
-                summary[level_idx]['GPUs'] += int(job_info['ReqGRES'].split(':')[1])
+            key_sums[0] += jobs
+            key_sums[1] += cpus
+            key_sums[2] += ram
+            key_sums[3] += nodes
+            key_sums[4] += gpus
+    return grouped
+
+def add_jobs(summary, summary_levels, sacct_lines):
+    """
+    Add the jobs in sacct output to summary. Identical lines (array tasks, mostly)
+    are counted first and parsed once, then each column is parsed as a whole,
+    every distinct value only once, and summed by summary_levels.
+    """
+    header, lines = slurm_io.read_header(sacct_lines)
+    job_counts = Counter(lines)
+    job_counts.pop('', None)
+    if len(job_counts) == 0:
+        return
+    columns = slurm_io.read_columns(header, slurm_io.split_rows(job_counts), sacct_fields.split(','))
+    jobs = list(job_counts.values())
+    # e.g. CANCELLED by 1234
+    states = map_distinct(lambda state: state.split(' ')[0].lower(), columns['State'])
+    cpus = [int(c) for c in columns['ReqCPUS']]
+    nodes = [int(n) for n in columns['ReqNodes']]
+    ram = [int(amount * (c if per == 'ReqCPUS' else n)) * j
+           for (amount, per), c, n, j in zip(map_distinct(get_job_memory, columns['ReqMem']), cpus, nodes, jobs)]
+    gpus = [g * j for g, j in zip(map_distinct(get_job_gpus, columns['ReqGRES']), jobs)]
+    columns['State'] = states
+    keys = list(zip(*[columns[x] for x in summary_levels]))
+    values = [jobs, [c * j for c, j in zip(cpus, jobs)], ram, [n * j for n, j in zip(nodes, jobs)], gpus]
+    for level_idx, sums in group_sums(keys, values).items():
+        level_info = summary[level_idx]
+        for column, value in zip(('Jobs', 'CPUs', 'RAM', 'Nodes', 'GPUs'), sums):
+            level_info[column] += value
+
+def merge_summary(summary, other):
+    for level_idx, info_dict in other.items():
+        for column, value in info_dict.items():
+            summary[level_idx][column] += value
+
+@slurm_io.timed
+def summarize_jobs(summary_levels, cluster=None, timeout=None):
+    summary = new_summary()
+    sacct_cmd = slurm_io.get_cluster_cmd(['sacct', '-XaPsR,PD,RQ', '-o' + sacct_fields], cluster)
+    add_jobs(summary, summary_levels, slurm_io.get_subprocess_lines(sacct_cmd, cache=True, timeout=timeout))
+    slurm_io.add_timing('summarize_jobs', jobs=sum(s['Jobs'] for s in summary.values()))
     return summary
 
-def print_summary(summary_dict, summary_levels, show_gpu, ram_units, sort_on, ascending):
-    sortable_columns = avail_sort
+def get_slices(start, end, hours):
+    from datetime import timedelta
+    slices = []
+    slice_start = start
+    while slice_start < end:
+        slice_end = min(slice_start + timedelta(hours=hours), end)
+        slices.append((slice_start.strftime(time_format), slice_end.strftime(time_format)))
+        slice_start = slice_end
+    return slices
+
+def summarize_slice(query_start, query_end, keep_from, keep_to, cluster=None, timeout=None):
+    """
+    Summarize, on every level, the jobs sacct finds between query_start and query_end
+    that became eligible in [keep_from, keep_to). A job shows up in every slice it was
+    eligible to run in, this counts it only in the one it became eligible in.
+    keep_from '' also keeps jobs that became eligible before the slice.
+    """
+    summary = new_summary()
+    sacct_cmd = slurm_io.get_cluster_cmd(['sacct', '-XaP', '-S', query_start, '-E', query_end,
+                                          '-o' + sacct_fields + ',Eligible,Submit'], cluster)
+    # each slice is asked for once, the rollup store is what saves querying it again
+    lines = slurm_io.get_subprocess_lines(sacct_cmd, cache=True, snapshot=False, timeout=timeout)
+    # Eligible and Submit are only needed to pick the jobs, drop them so identical jobs still add up together
+    header = next(lines, '').rsplit('|', 2)[0]
+    jobs = (job for job, eligible, submit in (line.rsplit('|', 2) for line in lines if line != '')
+            if keep_from <= (eligible if eligible[:1].isdigit() else submit) < keep_to)
+    add_jobs(summary, avail_levels, chain([header], jobs))
+    return summary
+
+def _summarize_slice(slice_args):
+    # pool threads can't raise, hand errors (and sys.exit) back instead
+    history_slice, cluster, timeout = slice_args
+    try:
+        return history_slice, summarize_slice(*history_slice[:4], cluster=cluster, timeout=timeout), None
+    except (Exception, SystemExit) as e:
+        return history_slice, None, e
+
+def get_rollup_path(rollup_path=None, cluster=None):
+    # one store per cluster, named after it
+    if rollup_path is None:
+        rollup_path = path.join(slurm_io.cache_settings['dir'], rollup_db)
+    return slurm_io.get_cluster_path(rollup_path, cluster)
+
+def open_rollups(rollup_path):
+    """
+    The per-day rollup store, or None if it can't be used.
+    """
+    if slurm_io.cache_settings['mode'] == 'bypass' or slurm_io.capture_settings['record'] or \
+       slurm_io.capture_settings['replay']:
+        return None
+    # the default store lives with the snapshots and is only as trustworthy as they are
+    if path.dirname(rollup_path) == slurm_io.cache_settings['dir'] and not slurm_io.usable_cache_dir():
+        return None
+    import sqlite3
+    try:
+        rollup_dir = path.dirname(rollup_path)
+        if rollup_dir != '' and not path.isdir(rollup_dir):
+            makedirs(rollup_dir, 0o755)
+        rollups = sqlite3.connect(rollup_path, timeout=60)
+        rollups.execute('CREATE TABLE IF NOT EXISTS rolled_days (day TEXT PRIMARY KEY, rolled_at REAL)')
+        rollups.execute('CREATE TABLE IF NOT EXISTS rollups (day TEXT, {}, {}, PRIMARY KEY (day, {}))'.format(
+            ', '.join('{} TEXT'.format(l) for l in avail_levels),
+            ', '.join('{} INTEGER'.format(s) for s in avail_sort),
+            ', '.join(avail_levels)))
+        return rollups
+    except (OSError, sqlite3.Error) as e:
+        print("Couldn't open rollups in {}, querying every day: {}".format(rollup_path, e), file=sys.stderr)
+        return None
+
+def get_rolled_days(rollups, days):
+    rolled = set()
+    for i in range(0, len(days), 500):
+        chunk = days[i:i+500]
+        rolled.update(r[0] for r in rollups.execute(
+            'SELECT day FROM rolled_days WHERE day IN ({})'.format(','.join('?' * len(chunk))), chunk))
+    return rolled
+
+def load_rollups(rollups, days, summary):
+    for i in range(0, len(days), 500):
+        chunk = days[i:i+500]
+        for row in rollups.execute('SELECT {}, {} FROM rollups WHERE day IN ({})'.format(
+                ', '.join(avail_levels), ', '.join(avail_sort), ','.join('?' * len(chunk))), chunk):
+            level_info = summary[tuple(row[:len(avail_levels)])]
+            for column, count in zip(avail_sort, row[len(avail_levels):]):
+                level_info[column] += count
+
+def store_rollup(rollups, day, summary):
+    with rollups:
+        rollups.execute('DELETE FROM rollups WHERE day = ?', (day,))
+        rollups.executemany('INSERT INTO rollups VALUES ({})'.format(','.join('?' * (1 + len(avail_levels) + len(avail_sort)))),
+                            [(day,) + level_idx + tuple(info[x] for x in avail_sort) for level_idx, info in summary.items()])
+        rollups.execute('INSERT OR REPLACE INTO rolled_days VALUES (?, ?)', (day, time.time()))
+
+def plan_history(start, end, hours, rolled, roll_before):
+    """
+    Split start to end into the days to load from rollups, and the slices to query
+    sacct for as (query start, query end, keep from, keep to, day to roll up or None).
+    Whole days that ended before roll_before are queried on their own and rolled up,
+    everything else is queried in slices of hours.
+    """
+    from datetime import datetime, timedelta
+    load_days, slices = [], []
+    window_start = start.strftime(time_format)
+    live_start = start
+    day_start = datetime.combine(start.date(), datetime.min.time())
+    if day_start < start:
+        day_start += timedelta(days=1)
+    while day_start + timedelta(days=1) <= end:
+        day_end = day_start + timedelta(days=1)
+        day = day_start.strftime('%Y-%m-%d')
+        if day in rolled or day_end <= roll_before:
+            for query_start, query_end in get_slices(live_start, day_start, hours):
+                slices.append((query_start, query_end, query_start, query_end, None))
+            live_start = day_end
+            if day in rolled:
+                load_days.append(day)
+            else:
+                slices.append((day_start.strftime(time_format), day_end.strftime(time_format),
+                               day_start.strftime(time_format), day_end.strftime(time_format), day))
+        day_start = day_end
+    for query_start, query_end in get_slices(live_start, end, hours):
+        slices.append((query_start, query_end, query_start, query_end, None))
+    # jobs that became eligible before the window are counted in its first slice,
+    # or on their own when the window starts with a rolled up day
+    if len(slices) > 0 and slices[0][0] == window_start and slices[0][4] is None:
+        slices[0] = (window_start, slices[0][1], '', slices[0][3], None)
+    else:
+        slices.insert(0, (window_start, window_start, '', window_start, None))
+    return load_days, slices
+
+@slurm_io.timed
+def summarize_history(summary_levels, start, end, hours, parallel, rollup_path=None, rollup_after=None,
+                      cluster=None, timeout=None):
+    """
+    Summarize every job between start and end with one sacct query per slice
+    of hours, parallel of them at a time, adding each slice in as it finishes.
+    Whole days at least rollup_after days old are kept in a rollup store at
+    rollup_path and only queried the first time they are asked for.
+    """
+    from datetime import datetime, timedelta
+    from multiprocessing.pool import ThreadPool
+    rollups = open_rollups(rollup_path) if rollup_path is not None else None
+    rolled = set()
+    if rollups is not None and slurm_io.cache_settings['mode'] == 'use':
+        days = [(start.date() + timedelta(days=d)).strftime('%Y-%m-%d') for d in range((end - start).days + 1)]
+        rolled = get_rolled_days(rollups, days)
+    roll_before = datetime.now() - timedelta(days=rollup_after) if rollups is not None else datetime.min
+    load_days, slices = plan_history(start, end, hours, rolled, roll_before)
+
+    full_summary = new_summary()
+    if len(load_days) > 0:
+        load_rollups(rollups, load_days, full_summary)
+    pool = ThreadPool(max(1, min(parallel, len(slices))))
+    try:
+        for slice_args, slice_summary, error in pool.imap_unordered(_summarize_slice,
+                                                                    [(s, cluster, timeout) for s in slices]):
+            if isinstance(error, SystemExit):
+                raise error
+            if error is not None:
+                sys.exit("Couldn't get job history: {}".format(error))
+            if slice_args[4] is not None:
+                store_rollup(rollups, slice_args[4], slice_summary)
+            merge_summary(full_summary, slice_summary)
+    finally:
+        pool.terminate()
+        if rollups is not None:
+            rollups.close()
+
+    # down to the levels asked for
+    level_positions = [avail_levels.index(l) for l in summary_levels]
+    summary = new_summary()
+    for level_idx, info in full_summary.items():
+        merge_summary(summary, {tuple(level_idx[i] for i in level_positions): info})
+    slurm_io.add_timing('summarize_history', rows=len(slices), days_rolled_up=len(load_days),
+                        jobs=sum(s['Jobs'] for s in summary.values()))
+    return summary
+
+def summarize_clusters(clusters, summarize):
+    """
+    summarize(cluster) for every cluster at once, merged, so the slowest cluster
+    sets how long it takes. A cluster that fails or times out is left out with a
+    warning, unless it's the only one.
+    """
+    def summarize_cluster(cluster):
+        try:
+            return cluster, summarize(cluster), None
+        except (Exception, SystemExit) as e:
+            return cluster, None, e
+
+    summary = new_summary()
+    errors = []
+    if len(clusters) == 1:
+        # nothing to wait on at the same time, or to start a pool for
+        results, pool = map(summarize_cluster, clusters), None
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(len(clusters))
+        results = pool.imap_unordered(summarize_cluster, clusters)
+    try:
+        for cluster, cluster_summary, error in results:
+            if error is not None:
+                errors.append((cluster, error))
+            else:
+                merge_summary(summary, cluster_summary)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if clusters == [None] and len(errors) > 0:
+        sys.exit("Couldn't get jobs: {}".format(errors[0][1]))
+    for cluster, error in errors:
+        print('Warning: skipping cluster {} ({})'.format(cluster, error), file=sys.stderr)
+    if len(errors) == len(clusters):
+        sys.exit("Couldn't get jobs from any cluster")
+    return summary
+
+def sort_summary(summary_dict, sort_on, ascending, top=None):
+    """
+    summary_dict's (levels, info) items sorted on sort_on, only the top ones with
+    the most of it if top is given, picked with a heap rather than sorting them all.
+    """
+    sort_key = lambda x: tuple(x[1][y] for y in sort_on)
+    level_items = summary_dict.items()
+    if top is not None:
+        level_items = heapq.nlargest(top, level_items, key=sort_key)
+    return sorted(level_items, key=sort_key, reverse=ascending)
+
+def get_summary_records(level_items, summary_levels, show_gpu, ram_units):
+    # each row of the table as a dict, for the machine readable --output formats
+    sortable_columns = [x for x in avail_sort if show_gpu or x != 'GPUs']
+    for level_idx, info_dict in level_items:
+        record = od(zip(summary_levels, level_idx))
+        for column in sortable_columns:
+            record[column] = round(info_dict['RAM'] / float(size_multipliers[ram_units]), 1) if column == 'RAM' \
+                             else info_dict[column]
+        yield record
+
+def format_summary(level_items, summary_levels, show_gpu, ram_units, output_format):
+    if output_format == 'prometheus':
+        # prometheus wants lower case names and bytes
+        records = [dict([(l.lower(), v) for l, v in zip(summary_levels, level_idx)] +
+                        [(c.lower(), info_dict[c]) for c in avail_sort if c != 'RAM'] +
+                        [('ram_bytes', info_dict['RAM'] * 1024 ** 2)])
+                   for level_idx, info_dict in level_items]
+        return slurm_io.format_prometheus(records, 'queue_summary', [l.lower() for l in summary_levels], summary_metrics)
+    records = get_summary_records(level_items, summary_levels, show_gpu, ram_units)
+    if output_format == 'ndjson':
+        return slurm_io.format_ndjson(records)
+    return slurm_io.format_csv(records, summary_levels + [x for x in avail_sort if show_gpu or x != 'GPUs'])
+
+@slurm_io.timed
+def print_summary(summary_dict, summary_levels, show_gpu, ram_units, sort_on, ascending, top=None, output_format='table'):
+    """
+    Print summary_dict sorted on sort_on as a table, or in output_format.
+    """
+    level_items = sort_summary(summary_dict, sort_on, ascending, top)
+    if output_format != 'table':
+        for line in format_summary(level_items, summary_levels, show_gpu, ram_units, output_format):
+            print(line)
+        return
+    sortable_columns = [x for x in avail_sort if show_gpu or x != 'GPUs']
     rows = [ ]
-    if not show_gpu:
-        sortable_columns.remove('GPUs')
     rows.append(summary_levels+sortable_columns)
-    for level_idx, info_dict in sorted(summary_dict.items(), key=lambda x: tuple(x[1][y] for y in sort_on), reverse=ascending):
-        info_dict['RAM'] = round((info_dict['RAM'] / size_multipliers[ram_units]), 1)
-        rows.append([str(a) for a in level_idx+tuple(info_dict[x] for x in sortable_columns)])
+    for level_idx, info_dict in level_items:
+        ram = round((info_dict['RAM'] / size_multipliers[ram_units]), 1)
+        rows.append([str(a) for a in level_idx+tuple(ram if x == 'RAM' else info_dict[x] for x in sortable_columns)])
     max_widths = [max(map(len, col)) for col in zip(*rows)]
     for row in rows:
         print(" ".join((val.ljust(width) for val, width in zip(row, max_widths))))
@@ -87,16 +427,93 @@ def get_args():
     parser.add_argument('-a', '--ascending',
                         action='store_true',
                         help='Sort in ascending order (default is descending).')
+    parser.add_argument('--top',
+                        type=int,
+                        metavar='N',
+                        help='Only show the N rows with the most of what is sorted on.')
+    parser.add_argument('-o', '--output',
+                        default='table',
+                        choices=['table'] + slurm_io.output_formats,
+                        help='Print the summary as a table, ndjson, csv or prometheus metrics. Default: table')
     parser.add_argument('-u', '--units',
                         default='G',
                         choices=list(size_multipliers.keys()),
                         help='What units to report memory in.')
+    history_args = parser.add_argument_group('History Options')
+    history_args.add_argument('--start',
+                              help='Summarize all jobs from this time (YYYY-MM-DD[THH:MM[:SS]]) instead of current ones.')
+    history_args.add_argument('--end',
+                              help='Summarize jobs up to this time. Default: now')
+    history_args.add_argument('--slice',
+                              default=slice_hours,
+                              type=float,
+                              metavar='hours',
+                              help='Query sacct for this many hours of history at a time. Default: {}'.format(slice_hours))
+    history_args.add_argument('--parallel',
+                              default=parallel_queries,
+                              type=int,
+                              metavar='N',
+                              help='Run up to N sacct queries at once. Default: {}'.format(parallel_queries))
+    history_args.add_argument('--rollups',
+                              metavar='FILE',
+                              help='Keep per-day totals in this SQLite file so each day is only queried once.' +
+                                   ' Default: {} in the cache directory. --no-cache disables them,'.format(rollup_db) +
+                                   ' --refresh-cache queries and rolls up again.')
+    history_args.add_argument('--rollup-after',
+                              default=rollup_after_days,
+                              type=float,
+                              metavar='days',
+                              help='Only roll up days that ended this many days ago, once their jobs are done.' +
+                                   ' Default: {}'.format(rollup_after_days))
+    slurm_args = parser.add_argument_group('Slurm Options')
+    slurm_args.add_argument('-M', '--clusters',
+                            metavar='cluster',
+                            action='append',
+                            help='Summarize jobs on the given cluster(s), comma separated, queried at the same time.' +
+                                 ' One that fails or times out is left out with a warning.')
+    slurm_args.add_argument('-t', '--timeout',
+                            type=float,
+                            metavar='seconds',
+                            help='Give up on any one sacct query after this many seconds. Default: no limit')
+    slurm_io.add_cache_args(parser)
+    slurm_io.add_capture_args(parser)
+    slurm_io.add_diagnostic_args(parser)
+    slurm_io.add_exporter_args(parser, exporter_interval)
     return vars(parser.parse_args())
 
 if __name__ == '__main__':
     args = get_args()
+    slurm_io.configure_cache(args)
+    slurm_io.configure_capture(args)
+    slurm_io.configure_diagnostics(args)
     levels = get_levels(args['levels'])
-    job_summary = summarize_jobs(levels)
+    clusters = slurm_io.get_clusters(args['clusters'])
     if 'GPUs' in args['sort_on']:
         args['gpu']=True
-    print_summary(job_summary, levels, args['gpu'], args['units'], args['sort_on'], args['ascending'])
+    if args['exporter'] is not None:
+        if args['start'] is not None or args['end'] is not None:
+            sys.exit("--exporter summarizes current jobs, it can't take --start or --end")
+        slurm_io.cap_cache_ttl(args['exporter_interval'])
+
+        def collect():
+            level_items = sort_summary(summarize_clusters(clusters, lambda cluster: summarize_jobs(
+                levels, cluster, args['timeout'])), args['sort_on'], args['ascending'], args['top'])
+            return dict(('/metrics' if f == 'prometheus' else '/' + f,
+                         (f, u''.join(line + u'\n' for line in format_summary(level_items, levels, args['gpu'],
+                                                                              args['units'], f))))
+                        for f in slurm_io.output_formats)
+        slurm_io.serve_exporter(slurm_io.get_exporter_address(args['exporter']), collect, args['exporter_interval'])
+        sys.exit(0)
+    if args['start'] is not None:
+        from datetime import datetime
+        start = slurm_io.parse_time(args['start'])
+        end = slurm_io.parse_time(args['end']) if args['end'] is not None else datetime.now().replace(microsecond=0)
+        job_summary = summarize_clusters(clusters, lambda cluster: summarize_history(
+            levels, start, end, args['slice'], args['parallel'], get_rollup_path(args['rollups'], cluster),
+            args['rollup_after'], cluster, args['timeout']))
+    elif args['end'] is not None:
+        sys.exit("--end needs a --start")
+    else:
+        job_summary = summarize_clusters(clusters, lambda cluster: summarize_jobs(levels, cluster, args['timeout']))
+    print_summary(job_summary, levels, args['gpu'], args['units'], args['sort_on'], args['ascending'], args['top'],
+                  args['output'])
@@ -0,0 +1,1043 @@
+# -*- coding: utf-8 -*-
+"""
+Slurm helpers shared by orwell-cli and queue-summary.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+import io
+import os
+import sys
+import json
+import time
+import fcntl
+import re
+import atexit
+import functools
+import threading
+from operator import itemgetter
+from collections import OrderedDict as od
+
+
+# Constants
+# where tempfile.gettempdir() looks first, without importing tempfile (and with it
+# shutil and random) on every run
+temp_dir = next((os.environ[v] for v in ['TMPDIR', 'TEMP', 'TMP'] if os.environ.get(v)), '/tmp')
+# where snapshots of slurm output are kept. It's only used if it's ours and no one
+# else can write to it.
+cache_dir = os.environ.get('ORWELL_CACHE_DIR',
+                           os.path.join(temp_dir, 'orwell-cache-{}'.format(os.getuid())))
+# where users share snapshots: a directory only its owner (an unprivileged service
+# account) can write to. Its owner publishes every snapshot it takes there, everyone else only
+# reads the ones its owner wrote.
+shared_cache_dir = os.environ.get('ORWELL_SHARED_CACHE_DIR')
+# seconds a snapshot is served before the next caller refreshes it
+cache_ttl = 60
+# mode is one of use: serve fresh snapshots, refresh: always re-run and store,
+# bypass: never touch the cache
+cache_settings = dict(dir=cache_dir, shared=shared_cache_dir, ttl=cache_ttl, mode='use')
+# unix socket a collector (orwell-cli --serve) answers on. Every local user can use
+# it, so a collector won't run as root or SlurmUser (see check_collector_user)
+collector_socket = os.environ.get('ORWELL_SOCKET',
+                                  os.path.join(temp_dir, 'orwell-collector.sock'))
+# the account (name or uid) a collector is deployed as. Other users only trust
+# a socket owned by it, by themselves or by root
+collector_user = os.environ.get('ORWELL_COLLECTOR_USER')
+# seconds a client waits on the collector, which may have to run a command it hasn't seen yet
+collector_timeout = 30
+# stop polling commands nobody has asked for in this many seconds
+collector_forget = 600
+# most commands a collector polls at once, new ones past this are turned away
+collector_max_commands = 64
+# the commands a collector runs for clients, exactly as orwell-cli (plan_queries,
+# plan_export, show_general_info, get_slurm_dir) and queue-summary (summarize_jobs)
+# make them: their fixed arguments and, for those with a list of fields last, the
+# flag it follows, its separator, the fields it starts with and the ones it may go
+# on to list, in order. Any of them may have -M cluster after the command.
+collector_commands = [
+    (['sinfo', '-a'], ('--format=', '|', ['%n'], ['%T', '%C', '%e', '%m', '%R', '%f', '%G'])),
+    (['sacct', '-XaPsR'], ('-o', ',', ['JobID', 'NodeList'], ['User', 'Account', 'Partition'])),
+    (['sacct', '-XaPsR,PD,RQ'], ('-o', ',', ['User', 'Account', 'State', 'Partition', 'ReqCPUS', 'ReqNodes',
+                                             'ReqMem', 'ReqGRES'], [])),
+    (['sinfo', '--format=%P', '-ha'], None),
+    (['sinfo', '-ha', '--format=%f'], None),
+    (['sinfo', '-ha', '--format=%G'], None),
+    (['sacctmgr', 'show', 'configuration'], None),
+]
+# where the collector reads SlurmUser from
+collector_config_cmd = ['sacctmgr', 'show', 'configuration']
+cluster_name_regex = re.compile(r'^[\w.-]+$')
+# directories to record slurm output and config files to, or replay them from
+capture_settings = dict(record=None, replay=None)
+# what each capture in a record/replay directory holds
+capture_manifest = 'manifest.json'
+# slurm output is read and decoded this many bytes at a time
+read_block_size = 64 * 1024
+# fields of slurm output are split on slurm_delim. Any space slurm puts before
+# one is dropped as the output is read
+slurm_delim = '|'
+# stage: calls, seconds and counts (rows, bytes, nodes, jobs...) for --timings
+timings = od()
+# columns --timings prints first, anything else counted follows
+timing_columns = ['calls', 'seconds', 'subprocess_seconds', 'bytes', 'rows', 'nodes', 'jobs']
+
+# times --start, --end, --at and the like accept
+input_time_formats = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d']
+# machine readable formats both scripts can --output instead of their own display
+output_formats = ['ndjson', 'csv', 'prometheus']
+# what an exporter (--exporter) serves the prometheus format as
+exporter_content_types = {'prometheus': 'text/plain; version=0.0.4; charset=utf-8',
+                          'ndjson': 'application/x-ndjson; charset=utf-8',
+                          'csv': 'text/csv; charset=utf-8'}
+# numpy once imported, see get_numpy
+_numpy = {}
+# why we're too privileged to share slurm output, see get_privileged_reason
+_privileged = {}
+_manifest_lock = threading.Lock()
+_timings_lock = threading.Lock()
+
+
+def add_cache_args(parser):
+    cache_args = parser.add_argument_group('Cache Options')
+    cache_args.add_argument('--cache-ttl',
+                            default=cache_ttl,
+                            type=float,
+                            metavar='seconds',
+                            help=('Reuse slurm output up to this many seconds old. 0 disables. Default: {}\n' +
+                                  ' Snapshots are kept in $ORWELL_CACHE_DIR, default {},\n' +
+                                  ' which is skipped unless it is yours and only you can write to it.').format(
+                                      cache_ttl, cache_dir))
+    cache_args.add_argument('--shared-cache-dir',
+                            default=shared_cache_dir,
+                            metavar='DIR',
+                            help=('Also read snapshots other users share in DIR, default $ORWELL_SHARED_CACHE_DIR. ' +
+                                  'Only snapshots written by the owner of DIR are read, and only if no one else ' +
+                                  'can write to it. Runs by its owner (a collector or a cron job as a service ' +
+                                  'account) publish what they query there. Its owner must be an unprivileged ' +
+                                  'account: runs as root or SlurmUser, who see past PrivateData, never publish.'))
+    cache_args.add_argument('--no-cache',
+                            action='store_true',
+                            help='Query slurm directly, without reading or writing snapshots.')
+    cache_args.add_argument('--refresh-cache',
+                            action='store_true',
+                            help='Query slurm and store fresh snapshots, ignoring cached ones.')
+
+
+def configure_cache(args):
+    cache_settings['ttl'] = args['cache_ttl']
+    cache_settings['shared'] = args['shared_cache_dir']
+    if args['no_cache'] or args['cache_ttl'] <= 0:
+        cache_settings['mode'] = 'bypass'
+    elif args['refresh_cache']:
+        cache_settings['mode'] = 'refresh'
+    else:
+        cache_settings['mode'] = 'use'
+
+
+def cap_cache_ttl(interval):
+    # for runs that repeat every interval: older snapshots would just repeat the last run
+    cache_settings['ttl'] = min(cache_settings['ttl'], interval)
+
+
+def add_capture_args(parser):
+    capture_args = parser.add_argument_group('Record/Replay Options').add_mutually_exclusive_group()
+    capture_args.add_argument('--record',
+                              metavar='DIR',
+                              help='Save the output of every slurm command and config file read to DIR.')
+    capture_args.add_argument('--replay',
+                              metavar='DIR',
+                              help='Read slurm output and config files saved with --record from DIR instead of slurm.')
+
+
+def configure_capture(args):
+    capture_settings['record'] = args['record']
+    capture_settings['replay'] = args['replay']
+    if args['record'] is not None and not os.path.isdir(args['record']):
+        try:
+            os.makedirs(args['record'])
+        except OSError as e:
+            sys.exit('Couldn\'t create {}: {}'.format(args['record'], e))
+    if args['replay'] is not None and not os.path.isfile(os.path.join(args['replay'], capture_manifest)):
+        sys.exit('Nothing recorded in {}'.format(args['replay']))
+
+
+def add_diagnostic_args(parser):
+    diagnostic_args = parser.add_argument_group('Diagnostic Options')
+    diagnostic_args.add_argument('--timings',
+                                 action='store_true',
+                                 help='Print time spent, rows and bytes read, and nodes and jobs seen per stage to stderr.')
+    diagnostic_args.add_argument('--profile',
+                                 metavar='FILE',
+                                 help='Profile the run and save the stats to FILE, for python -m pstats FILE.')
+
+
+def configure_diagnostics(args):
+    # atexit, so they are written however we exit
+    if args['timings']:
+        atexit.register(print_timings)
+    if args['profile'] is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        atexit.register(lambda: (profiler.disable(), profiler.dump_stats(args['profile'])))
+        profiler.enable()
+
+
+def add_timing(stage, **counts):
+    with _timings_lock:
+        stage_timings = timings.setdefault(stage, {})
+        for name, count in counts.items():
+            stage_timings[name] = stage_timings.get(name, 0) + count
+
+
+def timed(func):
+    """
+    Decorator that adds each call to func and the time it took to timings.
+    """
+    @functools.wraps(func)
+    def timed_func(*args, **kwargs):
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            add_timing(func.__name__, calls=1, seconds=time.time() - started)
+    return timed_func
+
+
+def print_timings():
+    with _timings_lock:
+        counted = set(name for stage_timings in timings.values() for name in stage_timings)
+        columns = [c for c in timing_columns if c in counted] + sorted(counted.difference(timing_columns))
+        rows = [['stage'] + columns]
+        for stage, stage_timings in timings.items():
+            rows.append([stage] + ['{:.3f}'.format(stage_timings[c]) if isinstance(stage_timings.get(c), float)
+                                   else str(stage_timings.get(c, '')) for c in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print(' '.join([row[0].ljust(widths[0])] + [v.rjust(w) for v, w in zip(row[1:], widths[1:])]),
+              file=sys.stderr)
+
+
+def get_numpy():
+    """
+    The numpy module, or None without it. numpy is optional, and slow enough to
+    import (~0.1s) that callers only ask for it when it pays off.
+    """
+    if 'module' not in _numpy:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy['module'] = numpy
+    return _numpy['module']
+
+
+def parse_time(time_string):
+    from datetime import datetime
+    for input_format in input_time_formats:
+        try:
+            return datetime.strptime(time_string, input_format)
+        except ValueError:
+            pass
+    sys.exit('Time not recognized: {}, use YYYY-MM-DD[THH:MM[:SS]]'.format(time_string))
+
+
+def get_clusters(cluster_args):
+    # the clusters given with -M, or [None] for just the one we're on
+    if cluster_args is None:
+        return [None]
+    return [c for c in ','.join(cluster_args).split(',') if c != '']
+
+
+def get_cluster_cmd(cmd, cluster):
+    # cmd run against one of several clusters (-M)
+    return cmd[:1] + ['-M', cluster] + cmd[1:] if cluster is not None else cmd
+
+
+def get_cluster_path(file_path, cluster):
+    # file_path for one of several clusters (-M): file-cluster.ext
+    if cluster is None:
+        return file_path
+    root, ext = os.path.splitext(file_path)
+    return '{}-{}{}'.format(root, cluster, ext)
+
+
+def usable_cache_dir():
+    """
+    Create the cache directory if it's missing and say whether it's safe to use:
+    owned by us and not writable by anyone else, who could plant snapshots in it.
+    """
+    import stat
+    try:
+        if not os.path.lexists(cache_settings['dir']):
+            os.makedirs(cache_settings['dir'], 0o700)
+        info = os.lstat(cache_settings['dir'])
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 0o022
+
+
+def shared_cache_owner():
+    """
+    The uid whose snapshots the shared cache directory holds, or None if there
+    isn't one or anyone but its owner could write to it.
+    """
+    import stat
+    if cache_settings['shared'] is None:
+        return None
+    try:
+        info = os.lstat(cache_settings['shared'])
+    except OSError:
+        return None
+    if not stat.S_ISDIR(info.st_mode) or info.st_mode & 0o022:
+        return None
+    return info.st_uid
+
+
+def get_snapshot_path(cmd, directory=None):
+    import hashlib
+    key = hashlib.sha1('\0'.join(cmd).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(directory or cache_settings['dir'], '{}-{}'.format(os.path.basename(cmd[0]), key))
+
+
+def _read_snapshot(snapshot, newer_than, owner=None):
+    """
+    Return the snapshot's lines if it was written after newer_than (and, given
+    an owner, is theirs and only writable by them), else None.
+    """
+    try:
+        with io.open(snapshot, 'r', encoding='utf-8') as snap:
+            info = os.fstat(snap.fileno())
+            if info.st_mtime < newer_than:
+                return None
+            if owner is not None and (info.st_uid != owner or info.st_mode & 0o022):
+                return None
+            return snap.read().splitlines()
+    except (IOError, OSError):
+        return None
+
+
+def _write_snapshot(snapshot, lines, mode=None):
+    # write next to the snapshot and rename over it so readers never see half a file
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(snapshot), prefix='.tmp-')
+    try:
+        with io.open(fd, 'w', encoding='utf-8') as tmp:
+            tmp.write(''.join(line + '\n' for line in lines))
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.rename(tmp_path, snapshot)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
+def read_shared_snapshot(cmd, newer_than):
+    owner = shared_cache_owner()
+    if owner is None:
+        return None
+    return _read_snapshot(get_snapshot_path(cmd, cache_settings['shared']), newer_than, owner)
+
+
+def publish_shared_snapshot(cmd, lines):
+    """
+    Share the output of cmd with every user if we own the shared cache directory,
+    unless we're root or SlurmUser, whose output PrivateData would hide from them.
+    """
+    if len(lines) == 0 or shared_cache_owner() != os.getuid():
+        return
+    reason = get_privileged_reason(lambda config_cmd: list(run_lines(config_cmd, collector_timeout)))
+    if reason is not None:
+        if not _privileged.get('warned'):
+            _privileged['warned'] = True
+            print('Warning: not sharing snapshots in {} ({}), give it to an unprivileged account'.format(
+                cache_settings['shared'], reason), file=sys.stderr)
+        return
+    _write_snapshot(get_snapshot_path(cmd, cache_settings['shared']), lines, 0o644)
+
+
+def _fetch_and_publish(cmd, fetch):
+    lines = fetch()
+    publish_shared_snapshot(cmd, lines)
+    return lines
+
+
+def cached_lines(cmd, fetch, ttl=None):
+    """
+    Return the output lines of cmd, from a running collector, a shared or a
+    private snapshot if any is fresh enough, otherwise from fetch(), which is called by at most one process at a time
+    per command. Anything going wrong with the cache falls back to fetch().
+    Empty output isn't stored: slurm commands print nothing on stdout when they fail.
+    ttl overrides the --cache-ttl for output that rarely changes.
+    """
+    mode, ttl = cache_settings['mode'], cache_settings['ttl'] if ttl is None else ttl
+    if mode == 'bypass':
+        return fetch()
+    fetch = functools.partial(_fetch_and_publish, cmd, fetch)
+    snapshot = get_snapshot_path(cmd)
+    asked_at = time.time()
+    if mode == 'use':
+        reply = ask_collector(cmd)
+        if reply is not None and reply['updated'] >= asked_at - ttl:
+            return reply['lines']
+        lines = read_shared_snapshot(cmd, asked_at - ttl)
+        if lines is not None:
+            return lines
+    if not usable_cache_dir():
+        return fetch()
+    if mode == 'use':
+        lines = _read_snapshot(snapshot, asked_at - ttl)
+        if lines is not None:
+            return lines
+    try:
+        lock_fd = os.open(snapshot + '.lock', os.O_RDONLY | os.O_CREAT, 0o600)
+    except OSError:
+        return fetch()
+    try:
+        # whoever gets the lock first refreshes; everyone else waits, then reads their snapshot
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        if mode == 'use':
+            lines = _read_snapshot(snapshot, time.time() - ttl)
+        else:
+            lines = _read_snapshot(snapshot, asked_at)
+        if lines is None:
+            lines = fetch()
+            if len(lines) > 0:
+                _write_snapshot(snapshot, lines)
+        return lines
+    finally:
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
+
+
+def load_cached_json(key):
+    """
+    Whatever store_cached_json last stored under key, or None. Only used when
+    the cache is, i.e. not with --no-cache, --refresh-cache, --record or --replay.
+    """
+    if cache_settings['mode'] != 'use' or capture_settings['record'] or capture_settings['replay'] or \
+       not usable_cache_dir():
+        return None
+    lines = _read_snapshot(get_snapshot_path(key), 0)
+    try:
+        return json.loads(lines[0]) if lines else None
+    except ValueError:
+        return None
+
+
+def store_cached_json(key, data):
+    if cache_settings['mode'] == 'bypass' or capture_settings['record'] or capture_settings['replay'] or \
+       not usable_cache_dir():
+        return
+    _write_snapshot(get_snapshot_path(key), [json.dumps(data)])
+
+
+def _record(key, lines):
+    name = os.path.basename(get_snapshot_path(key))
+    if lines is not None:
+        with io.open(os.path.join(capture_settings['record'], name), 'w', encoding='utf-8') as capture:
+            capture.write(''.join(lines))
+    manifest_path = os.path.join(capture_settings['record'], capture_manifest)
+    with _manifest_lock:
+        try:
+            with io.open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, OSError, ValueError):
+            manifest = {}
+        manifest[name] = {'source': list(key), 'missing': lines is None, 'recorded': time.time()}
+        with io.open(manifest_path, 'w', encoding='utf-8') as manifest_file:
+            manifest_file.write(json.dumps(manifest, indent=1, sort_keys=True))
+
+
+def _replay(key):
+    name = os.path.basename(get_snapshot_path(key))
+    try:
+        with io.open(os.path.join(capture_settings['replay'], capture_manifest), 'r', encoding='utf-8') as manifest_file:
+            entry = json.load(manifest_file).get(name)
+    except (IOError, OSError, ValueError):
+        entry = None
+    if entry is None:
+        sys.exit('{} wasn\'t recorded in {}, record with the same options you replay with'.format(
+            ' '.join(key[1:] if key[0] == 'file' else key), capture_settings['replay']))
+    if entry['missing']:
+        return None
+    with io.open(os.path.join(capture_settings['replay'], name), 'r', encoding='utf-8') as capture:
+        return capture.readlines()
+
+
+def captured_lines(cmd, fetch):
+    """
+    Return the output lines of cmd as saved by --replay, otherwise from fetch(),
+    saving them when recording.
+    """
+    if capture_settings['replay'] is not None:
+        return [line.rstrip('\n') for line in _replay(cmd)]
+    lines = fetch()
+    if capture_settings['record'] is not None:
+        _record(cmd, [line + '\n' for line in lines])
+    return lines
+
+
+def read_file_lines(file_path):
+    """
+    Lines of a config file, line endings kept, or None if it can't be read.
+    Recorded and replayed like command output.
+    """
+    key = ['file', file_path]
+    if capture_settings['replay'] is not None:
+        return _replay(key)
+    lines = None
+    if os.path.isfile(file_path) and os.access(file_path, os.R_OK):
+        with io.open(file_path, 'r', encoding='utf-8') as config:
+            lines = config.readlines()
+    if capture_settings['record'] is not None:
+        _record(key, lines)
+    return lines
+
+
+def read_output_lines(stream, counts=None):
+    """
+    Lines of a slurm command's output, read and decoded a block at a time rather
+    than a line at a time. With -M, slurm puts a CLUSTER: name line before the
+    output, those are left out. The bytes read are added to counts['bytes'].
+    """
+    tail = b''
+    while True:
+        block = stream.read(read_block_size)
+        if counts is not None:
+            counts['bytes'] += len(block)
+        if not block:
+            if not tail:
+                break
+            # the last line, without a line ending
+            block = b'\n'
+        block = tail + block
+        end = block.rfind(b'\n') + 1
+        tail = block[end:]
+        if end == 0:
+            continue
+        text = block[:end].decode('utf-8', 'replace')
+        if ' ' + slurm_delim in text:
+            text = text.replace(' ' + slurm_delim, slurm_delim)
+        lines = text.split('\n')
+        lines.pop()
+        for line in lines:
+            line = line.strip()
+            if not line.startswith('CLUSTER: '):
+                yield line
+
+
+def run_lines(cmd, timeout=None):
+    """
+    Run a slurm command and yield its output lines. Raises RuntimeError if it
+    runs longer than timeout seconds, and is killed, or exits non-zero.
+    """
+    import subprocess
+    started = time.time()
+    try:
+        pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    except OSError:
+        sys.exit("Couldn't find slurm commands. Are you sure you're on a slurm cluster?")
+    # kill the command if it runs past timeout, and remember that we did
+    expired = []
+    timer = None
+    if timeout:
+        def expire():
+            expired.append(True)
+            pipe.kill()
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+    counts = {'bytes': 0}
+    try:
+        for line in read_output_lines(pipe.stdout, counts):
+            yield line
+        pipe.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+            timer.join()
+        # don't leave the command running if we stopped reading early
+        if pipe.poll() is None:
+            pipe.kill()
+            pipe.wait()
+        pipe.stdout.close()
+        add_timing(cmd[0], subprocess_seconds=time.time() - started, bytes=counts['bytes'])
+    if expired:
+        raise RuntimeError('{} timed out after {:g}s'.format(cmd[0], timeout))
+    if pipe.returncode != 0:
+        raise RuntimeError('{} exited with {}'.format(cmd[0], pipe.returncode))
+
+
+def get_subprocess_lines(cmd, timeout=None, cache=False, cache_ttl=None, snapshot=True):
+    """
+    Output lines of a slurm command, header first. With cache, they come from
+    (and go to) the collector, snapshot cache and --record/--replay captures.
+    snapshot=False leaves output no one will ask for again out of the snapshot
+    cache and collector, it's still recorded and replayed.
+    """
+    if not cache:
+        return run_lines(cmd, timeout)
+    started = time.time()
+    fetch = lambda: list(run_lines(cmd, timeout))
+    if snapshot:
+        fetch = functools.partial(cached_lines, cmd, fetch, cache_ttl)
+    lines = captured_lines(cmd, fetch)
+    add_timing(cmd[0], calls=1, seconds=time.time() - started, rows=max(0, len(lines) - 1))
+    return iter(lines)
+
+
+def read_header(lines):
+    """
+    The header of slurm output as {column: index}, and the rest of its lines.
+    """
+    lines = iter(lines)
+    header = next(lines, '')
+    return dict((column, i) for i, column in enumerate(header.split(slurm_delim)) if column != ''), lines
+
+
+def split_rows(lines):
+    # lines, header left off, as tuples of their fields
+    return (tuple(line.split(slurm_delim)) for line in lines if line != '')
+
+
+def read_rows(lines):
+    """
+    The header of slurm output as {column: index} and its rows as tuples of fields.
+    """
+    header, lines = read_header(lines)
+    return header, split_rows(lines)
+
+
+def select_columns(header, columns, missing=None):
+    """
+    A function of a row giving a tuple of just the columns asked for, in that
+    order. Columns the header doesn't have, because they weren't queried, are
+    missing.
+    """
+    indices = [header.get(column, -1) for column in columns]
+    select = itemgetter(*indices) if len(indices) > 1 else lambda row: (row[indices[0]],)
+    if -1 not in indices:
+        return select
+    # missing columns are read from past the end of the row
+    return lambda row: select(row + (missing,))
+
+
+def read_columns(header, rows, columns, missing=None):
+    """
+    rows as {column: tuple of its values}, for each of columns. Columns the
+    header doesn't have are all missing.
+    """
+    rows = list(rows)
+    values = list(zip(*rows)) or [()] * len(header)
+    return dict((column, values[header[column]] if column in header else (missing,) * len(rows))
+                for column in columns)
+
+
+def _fields_allowed(fields, first, others):
+    # fields starts with first, then lists some of others in their order
+    if fields[:len(first)] != first:
+        return False
+    rest = iter(others)
+    return all(field in rest for field in fields[len(first):])
+
+
+def collector_allows(cmd):
+    """
+    Whether cmd is one of collector_commands. The collector runs commands as
+    itself on behalf of other users, over and over, so nothing else is run:
+    not other flags, fields or time ranges.
+    """
+    if not (isinstance(cmd, list) and len(cmd) > 0 and all(isinstance(a, type('')) for a in cmd)):
+        return False
+    if len(cmd) > 2 and cmd[1] == '-M':
+        if cluster_name_regex.match(cmd[2]) is None:
+            return False
+        cmd = cmd[:1] + cmd[3:]
+    for fixed, field_list in collector_commands:
+        if field_list is None:
+            if cmd == fixed:
+                return True
+            continue
+        flag, separator, first, others = field_list
+        if len(cmd) == len(fixed) + 1 and cmd[:-1] == fixed and cmd[-1].startswith(flag) and \
+           _fields_allowed(cmd[-1][len(flag):].split(separator), first, others):
+            return True
+    return False
+
+
+def get_collector_uid():
+    # uid of collector_user, or None if it isn't set or there's no such account
+    if collector_user is None:
+        return None
+    if collector_user.isdigit():
+        return int(collector_user)
+    import pwd
+    try:
+        return pwd.getpwnam(collector_user).pw_uid
+    except KeyError:
+        return None
+
+
+def ask_collector(cmd):
+    """
+    Ask a running collector for the output of cmd. Returns a dict with lines and
+    updated (when it last ran cmd), or None if no collector could answer.
+    """
+    try:
+        owner = os.stat(collector_socket).st_uid
+    except OSError:
+        return None
+    # anyone can create a socket in /tmp, only trust ours, root's, the collector account's,
+    # or one we were pointed at
+    if owner not in [0, os.getuid(), get_collector_uid()] and 'ORWELL_SOCKET' not in os.environ:
+        return None
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(collector_timeout)
+        sock.connect(collector_socket)
+        sock.sendall((json.dumps({'cmd': list(cmd)}) + '\n').encode('utf-8'))
+        reply = json.loads(sock.makefile('rb').readline().decode('utf-8'))
+    except (socket.error, OSError, ValueError):
+        return None
+    finally:
+        sock.close()
+    if 'lines' not in reply:
+        return None
+    return reply
+
+
+def _import_socketserver():
+    # only the collector and exporter serve anything, other runs don't import it
+    try:
+        import socketserver
+    except ImportError:
+        import SocketServer as socketserver
+    return socketserver
+
+
+def _refresh_snapshot(fetch, cmd, snap):
+    try:
+        lines = fetch(cmd)
+    except (Exception, SystemExit) as e:
+        snap['error'] = str(e)
+        print('Warning: {} failed ({})'.format(' '.join(cmd), e), file=sys.stderr)
+        return
+    snap['lines'], snap['updated'], snap['error'] = lines, time.time(), None
+    publish_shared_snapshot(cmd, lines)
+
+
+def _poll_snapshots(fetch, snapshots, snapshots_lock, interval):
+    while True:
+        started = time.time()
+        with snapshots_lock:
+            for key in [k for k, snap in snapshots.items() if started - snap['asked'] > collector_forget]:
+                del snapshots[key]
+            polling = list(snapshots.items())
+        threads = []
+        for key, snap in polling:
+            def refresh(cmd=list(key), snap=snap):
+                with snap['lock']:
+                    _refresh_snapshot(fetch, cmd, snap)
+            thread = threading.Thread(target=refresh)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        time.sleep(max(0, interval - (time.time() - started)))
+
+
+def get_privileged_reason(fetch):
+    """
+    Why our slurm output mustn't be handed to other users, or None: root and
+    SlurmUser see past PrivateData. Also given when SlurmUser can't be read.
+    Asked once per run, fetch(cmd) runs cmd and returns its lines.
+    """
+    if 'reason' not in _privileged:
+        _privileged['reason'] = _find_privileged_reason(fetch)
+    return _privileged['reason']
+
+
+def _find_privileged_reason(fetch):
+    if os.getuid() == 0:
+        return 'we are root'
+    import pwd
+    try:
+        config = fetch(collector_config_cmd)
+    except (Exception, SystemExit) as e:
+        return 'couldn\'t read SlurmUser to check we aren\'t it: {}'.format(e)
+    user = pwd.getpwuid(os.getuid()).pw_name
+    for line in config:
+        fields = line.split()
+        # SlurmUser = slurm(202)
+        if len(fields) == 3 and fields[0] == 'SlurmUser' and fields[2].split('(')[0] == user:
+            return 'we are SlurmUser'
+    return None
+
+
+def check_collector_user(fetch):
+    """
+    Exit if we're root or SlurmUser. Anyone local can ask the collector for
+    sacct -a, so it must only see what PrivateData lets an ordinary user see.
+    """
+    reason = get_privileged_reason(fetch)
+    if reason is not None:
+        sys.exit('The collector answers every local user, run it as an unprivileged account ({})'.format(reason))
+
+
+def _exit_on_sigterm(signum, frame):
+    # service managers stop us with SIGTERM, exit so the socket is cleaned up
+    sys.exit(0)
+
+
+def serve_collector(fetch, interval, commands):
+    """
+    Run slurm commands once per interval on behalf of every client, starting
+    with commands and adding whatever clients ask for, and answer clients on
+    collector_socket with the latest output. fetch(cmd) runs cmd and returns its lines.
+    Refuses to run as root or SlurmUser, see check_collector_user.
+    """
+    import socket
+    import signal
+    check_collector_user(fetch)
+    if collector_user is not None and get_collector_uid() != os.getuid():
+        print('Warning: $ORWELL_COLLECTOR_USER is {}, not us, other users won\'t trust this collector'.format(
+            collector_user), file=sys.stderr)
+    socketserver = _import_socketserver()
+
+    class CollectorHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                reply = self.server.answer(json.loads(line.decode('utf-8')).get('cmd'))
+            except (ValueError, AttributeError):
+                reply = {'error': 'bad request'}
+            try:
+                self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            except socket.error:
+                # client gave up waiting
+                pass
+
+    class CollectorServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    snapshots = {}
+    snapshots_lock = threading.Lock()
+
+    def get_snapshot(cmd):
+        with snapshots_lock:
+            if tuple(cmd) not in snapshots and len(snapshots) >= collector_max_commands:
+                return None
+            snap = snapshots.setdefault(tuple(cmd), {'lines': None, 'updated': 0, 'error': None,
+                                                     'asked': time.time(), 'lock': threading.Lock()})
+            snap['asked'] = time.time()
+            return snap
+
+    def answer(cmd):
+        if not collector_allows(cmd):
+            return {'error': 'not a command the collector runs'}
+        snap = get_snapshot(cmd)
+        if snap is None:
+            # the client runs it itself
+            return {'error': 'already polling {} commands'.format(collector_max_commands)}
+        if snap['lines'] is None:
+            # first time anyone asked, run it now rather than make them wait a whole interval
+            with snap['lock']:
+                if snap['lines'] is None:
+                    _refresh_snapshot(fetch, cmd, snap)
+        if snap['lines'] is None:
+            return {'error': snap['error']}
+        return {'lines': snap['lines'], 'updated': snap['updated']}
+
+    for cmd in commands:
+        get_snapshot(cmd)
+    if os.path.exists(collector_socket):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(collector_socket)
+            sys.exit('A collector is already running on {}'.format(collector_socket))
+        except socket.error:
+            # left behind by a collector that didn't shut down cleanly
+            try:
+                os.unlink(collector_socket)
+            except OSError as e:
+                sys.exit('Couldn\'t remove the stale socket {}, remove it or set $ORWELL_SOCKET: {}'.format(
+                    collector_socket, e))
+        finally:
+            probe.close()
+    server = CollectorServer(collector_socket, CollectorHandler)
+    server.answer = answer
+    # open to every user, which is why it mustn't run privileged
+    os.chmod(collector_socket, 0o666)
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    poller = threading.Thread(target=_poll_snapshots, args=(fetch, snapshots, snapshots_lock, interval))
+    poller.daemon = True
+    poller.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(collector_socket)
+
+
+def format_ndjson(records):
+    for record in records:
+        yield json.dumps(record)
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        value = ','.join(value)
+    value = '{}'.format(value)
+    if any(c in value for c in ',"\n'):
+        return '"{}"'.format(value.replace('"', '""'))
+    return value
+
+
+def format_csv(records, fields):
+    yield ','.join(fields)
+    for record in records:
+        yield ','.join(_csv_value(record[field]) for field in fields)
+
+
+def _prometheus_label(value):
+    if isinstance(value, (list, tuple)):
+        value = ','.join(value)
+    return '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus(records, prefix, labels, values):
+    """
+    A gauge for each of values (name: help), with one sample per record labeled
+    with its labels. None values, and labels, are left out.
+    """
+    records = list(records)
+    for value, value_help in values.items():
+        yield '# HELP {}_{} {}'.format(prefix, value, value_help)
+        yield '# TYPE {}_{} gauge'.format(prefix, value)
+        for record in records:
+            if record[value] is None:
+                continue
+            sample_labels = ','.join('{}="{}"'.format(label, _prometheus_label(record[label]))
+                                     for label in labels if record[label] is not None)
+            yield '{}_{}{{{}}} {}'.format(prefix, value, sample_labels, record[value])
+
+
+def format_prometheus_info(records, name, name_help, labels):
+    """
+    A gauge that is 1 for each record, carrying labels that change too often or
+    are too long to put on every other gauge.
+    """
+    yield '# HELP {} {}'.format(name, name_help)
+    yield '# TYPE {} gauge'.format(name)
+    for record in records:
+        sample_labels = ','.join('{}="{}"'.format(label, _prometheus_label(record[label]))
+                                 for label in labels if record[label] is not None)
+        yield '{}{{{}}} 1'.format(name, sample_labels)
+
+
+def add_exporter_args(parser, interval):
+    exporter_args = parser.add_argument_group('Exporter Options')
+    exporter_args.add_argument('--exporter',
+                               metavar='[HOST:]PORT',
+                               help='Serve the latest collection over HTTP on PORT: /metrics in prometheus format,' +
+                                    ' /ndjson and /csv. Scrapes are answered from memory, never by querying slurm.')
+    exporter_args.add_argument('--exporter-interval',
+                               default=interval,
+                               type=float,
+                               metavar='seconds',
+                               help='How often the exporter collects. Default: {}'.format(interval))
+
+
+def get_exporter_address(exporter):
+    host, _, port = exporter.rpartition(':')
+    if not port.isdigit():
+        sys.exit('--exporter needs a port number, not {}'.format(exporter))
+    return host, int(port)
+
+
+def _collect_pages(collect, pages):
+    try:
+        collected = collect()
+    except (Exception, SystemExit) as e:
+        pages['error'] = str(e)
+        print('Warning: collection failed ({})'.format(e), file=sys.stderr)
+        return
+    pages['pages'], pages['updated'], pages['error'] = collected, time.time(), None
+
+
+def _poll_pages(collect, pages, interval, last):
+    while True:
+        time.sleep(max(0, interval - (time.time() - last)))
+        last = time.time()
+        _collect_pages(collect, pages)
+
+
+def serve_exporter(address, collect, interval):
+    """
+    Run collect() once per interval and serve what it last returned, a dict of
+    path: (format, text), over HTTP on address. A scrape only ever reads the
+    last collection, however often it comes.
+    """
+    import socket
+    socketserver = _import_socketserver()
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+    pages = {'pages': None, 'updated': 0, 'error': None}
+
+    class ExporterHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            collected = pages['pages']
+            page = self.path.split('?')[0]
+            if collected is None:
+                self.reply(503, 'text/plain', 'nothing collected yet: {}\n'.format(pages['error']))
+            elif page not in collected:
+                self.reply(404, 'text/plain', 'try {}\n'.format(', '.join(sorted(collected))))
+            else:
+                output_format, text = collected[page]
+                self.reply(200, exporter_content_types[output_format], text)
+
+        def reply(self, status, content_type, text):
+            body = text.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Last-Modified', self.date_time_string(pages['updated']))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class ExporterServer(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    try:
+        server = ExporterServer(address, ExporterHandler)
+    except socket.error as e:
+        sys.exit('Couldn\'t serve on {}:{}: {}'.format(address[0], address[1], e))
+    # have something to serve from the start
+    started = time.time()
+    _collect_pages(collect, pages)
+    poller = threading.Thread(target=_poll_pages, args=(collect, pages, interval, started))
+    poller.daemon = True
+    poller.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()